@@ -27,7 +27,7 @@
     'author': "Jorels SAS",
     'license': "LGPL-3",
     'category': 'Invoicing & Payments',
-    'version': '12.0.22.08.03.14.10',
+    'version': '12.0.26.10.17.13.00',
     'website': "https://www.jorels.com",
     'images': ['static/images/main_screenshot.png'],
     'support': 'info@jorels.com',
@@ -47,6 +47,7 @@
         'security/ir.model.access.csv',
         'data/ir_sequence_data.xml',
         'data/data.xml',
+        'data/ir_cron_data.xml',
         'views/config/res_company.xml',
         'views/config/res_config_settings_views.xml',
         'views/config/resolution_views.xml',
@@ -60,7 +61,11 @@
         'views/res_partner_view.xml',
         'views/mail_message_views.xml',
         'views/account_invoice_refund_view.xml',
+        'views/account_invoice_validate_dian_view.xml',
         'views/radian_views.xml',
+        'views/submission_views.xml',
+        'views/account_invoice_reconcile_dian_view.xml',
+        'views/ledger_views.xml',
         'report/report_invoice.xml',
         'data/mail_template_data.xml',
     ],
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # The API ID becomes unique: the duplicated resolutions are archived without it
+    cr.execute("SELECT 1 FROM information_schema.columns "
+               "WHERE table_name = 'l10n_co_edi_jorels_resolution' AND column_name = 'active'")
+    active = ", active = FALSE" if cr.fetchone() else ""
+    cr.execute("""
+        UPDATE l10n_co_edi_jorels_resolution r
+        SET resolution_id = NULL%s
+        WHERE r.resolution_id IS NOT NULL AND EXISTS (
+            SELECT 1 FROM l10n_co_edi_jorels_resolution other
+            WHERE other.resolution_id = r.resolution_id AND other.id < r.id
+        )
+    """ % active)
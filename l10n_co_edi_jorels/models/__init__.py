@@ -20,7 +20,13 @@
 # email: info@jorels.com
 #
 
-# First load configuration
+# First load the API client and configuration
+from . import edipo
+from . import ledger
+from . import catalog
+from . import qr
+from . import amount_words
+from . import status_poll
 from . import config
 from . import listings
 
@@ -29,6 +35,10 @@ from . import res_partner
 from . import account_invoice
 from . import account_invoice_line
 from . import account_invoice_refund
+from . import account_invoice_validate_dian
+from . import account_invoice_reconcile_dian
 from . import mail_message
 from . import mail_template
+from . import ir_actions_report
 from . import radian
+from . import submission
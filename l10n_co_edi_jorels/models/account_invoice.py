@@ -21,23 +21,51 @@
 #
 
 import base64
+import hashlib
 import json
 import logging
-import math
 import re
+import threading
+from collections import OrderedDict
 from io import BytesIO
 
-import qrcode
 import requests
-from num2words import num2words
-from odoo import api, fields, models, _
+from lxml import etree
+from odoo import api, fields, models, tools, _
 from odoo.exceptions import UserError
 
+from .edipo import error_message
+from .payload import compress_payload, decompress_payload
+
 _logger = logging.getLogger(__name__)
 
+# Invoice fields restored from a DIAN log, and their keys in the log
+LOG_FIELDS = (
+    ('ei_algorithm', 'algorithm'),
+    ('ei_uuid', 'uuid'),
+    ('ei_issue_date', 'issue_date'),
+    ('ei_zip_key', 'zip_key'),
+    ('ei_xml_name', 'xml_name'),
+    ('ei_zip_name', 'zip_name'),
+    ('ei_xml_base64_bytes', 'xml_base64_bytes'),
+    ('ei_qr_data', 'qr_data'),
+    ('ei_application_response_base64_bytes', 'application_response_base64_bytes'),
+    ('ei_attached_document_base64_bytes', 'attached_document_base64_bytes'),
+    ('ei_pdf_base64_bytes', 'pdf_base64_bytes'),
+    ('ei_zip_base64_bytes', 'zip_base64_bytes'),
+    ('ei_signature', 'signature'),
+)
+
+# Payloads already built by this worker: (dbname, invoice id) -> (fingerprint, json payload)
+_payload_cache = OrderedDict()
+_payload_cache_lock = threading.Lock()
+_payload_cache_stats = {'hits': 0, 'misses': 0}
+PAYLOAD_CACHE_SIZE = 1024
+
 
 class AccountInvoice(models.Model):
-    _inherit = "account.invoice"
+    _name = "account.invoice"
+    _inherit = ["account.invoice", "l10n_co_edi_jorels.status_poll.mixin"]
     _description = "Electronic invoicing"
 
     state = fields.Selection(selection_add=[('validate', 'Validating DIAN')])
@@ -62,7 +90,8 @@ class AccountInvoice(models.Model):
     ei_algorithm = fields.Char(string="Algorithm", copy=False, readonly=True)
     ei_class = fields.Char("Class", copy=False, readonly=True)
     ei_number = fields.Char(string="Number", compute="compute_number_formatted", store=True, copy=False, readonly=True)
-    ei_uuid = fields.Char(string="UUID", copy=False, readonly=True, states={'draft': [('readonly', False)]})
+    ei_uuid = fields.Char(string="UUID", copy=False, readonly=True, index=True,
+                          states={'draft': [('readonly', False)]})
     ei_issue_date = fields.Date(string="Issue date", copy=False, readonly=True,
                                 states={'draft': [('readonly', False)]})
     ei_expedition_date = fields.Char("Expedition date", copy=False, readonly=True)
@@ -86,11 +115,14 @@ class AccountInvoice(models.Model):
     ei_pdf_base64_bytes = fields.Binary('Pdf document', attachment=True, copy=False, readonly=True,
                                         states={'draft': [('readonly', False)]})
     ei_zip_base64_bytes = fields.Binary('Zip document', attachment=True, copy=False, readonly=True)
+    # Printed PDF of the valid electronic invoice, the attachment name is the version of the print
+    ei_pdf_cache = fields.Binary('Printed PDF', attachment=True, copy=False, readonly=True)
     ei_type_environment = fields.Many2one(comodel_name="l10n_co_edi_jorels.type_environments",
                                           string="Type environment", copy=False, readonly=True,
                                           states={'draft': [('readonly', False)]},
                                           default=lambda self: self._default_ei_type_environment())
-    ei_payload = fields.Text("Payload", copy=False, readonly=True)
+    ei_payload = fields.Text("Payload", compute="_compute_ei_payload", inverse="_inverse_ei_payload", readonly=True)
+    ei_payload_data = fields.Binary("Compressed payload", attachment=True, copy=False, readonly=True)
 
     # Old fields, compatibility
     ei_xml_file_name = fields.Char(string="Xml file name", copy=False, readonly=True)
@@ -103,9 +135,10 @@ class AccountInvoice(models.Model):
     # For mail attached
     ei_attached_zip_base64_bytes = fields.Binary('Attached zip', attachment=True, copy=False, readonly=True,
                                                  states={'draft': [('readonly', False)]})
+    ei_attached_zip_checksum = fields.Char("Attached zip checksum", copy=False, readonly=True)
 
     # QR image
-    ei_qr_image = fields.Binary("QR image", attachment=True, copy=False, readonly=True)
+    ei_qr_image = fields.Binary("QR image", compute="_compute_ei_qr_image")
 
     # Total taxes only / without withholdings
     ei_amount_tax_withholding = fields.Monetary("Withholdings", compute="_compute_amount", store=True)
@@ -135,7 +168,16 @@ class AccountInvoice(models.Model):
 
     value_letters = fields.Char("Value in letters", compute="_compute_amount", store=True)
 
-    is_attached_document_matched = fields.Boolean("Correct number in attached document?", copy=False,
+    # Header values of the attached document, extracted when it is saved
+    ei_attached_parent_document_id = fields.Char("Attached document number", copy=False, readonly=True, index=True,
+                                                 compute='_compute_attached_document_data', store=True)
+    ei_attached_uuid = fields.Char("Attached document UUID", copy=False, readonly=True, index=True,
+                                   compute='_compute_attached_document_data', store=True)
+    ei_attached_issue_date = fields.Date("Attached document issue date", copy=False, readonly=True,
+                                         compute='_compute_attached_document_data', store=True)
+    ei_attached_payable_amount = fields.Float("Attached document payable amount", copy=False, readonly=True,
+                                              compute='_compute_attached_document_data', store=True)
+    is_attached_document_matched = fields.Boolean("Correct number in attached document?", copy=False, index=True,
                                                   compute='_is_attached_document_matched', store=True)
     ei_operation = fields.Selection([
         ('aiu', 'AIU'),
@@ -186,6 +228,16 @@ class AccountInvoice(models.Model):
 
     radian_ids = fields.One2many(comodel_name='l10n_co_edi_jorels.radian', inverse_name='invoice_id')
 
+    # Background submission to DIAN
+    submission_ids = fields.One2many(comodel_name='l10n_co_edi_jorels.submission', inverse_name='invoice_id',
+                                     string="DIAN submissions", readonly=True, copy=False,
+                                     domain=[('job_type', '=', 'dian')])
+    ei_submission_state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('error', 'Error'),
+    ], string="Submission status", compute="_compute_ei_submission_state")
+
     @api.multi
     def _default_ei_type_environment(self):
         if not self.env['l10n_co_edi_jorels.type_environments'].search_count([]):
@@ -200,6 +252,12 @@ class AccountInvoice(models.Model):
             else:
                 rec.ei_is_not_test = rec.company_id.is_not_test
 
+    @api.depends('submission_ids.state')
+    def _compute_ei_submission_state(self):
+        for rec in self:
+            # Submissions are sorted from newest to oldest
+            rec.ei_submission_state = rec.submission_ids[:1].state
+
     @api.multi
     def _default_payment_method_id(self):
         if not self.env['l10n_co_edi_jorels.payment_methods'].search_count([]):
@@ -233,71 +291,90 @@ class AccountInvoice(models.Model):
         for rec in self:
             rec.is_out_country = rec.get_default_is_out_country()
 
+    @api.model
+    def _get_pos_journal_ids(self, journal_ids):
+        """Ids of the given journals that are used by a point of sale, in one query"""
+        if 'pos.config' not in self.env or not journal_ids:
+            return set()
+        pos_configs = self.env['pos.config'].sudo().search_read(
+            [('invoice_journal_id', 'in', list(journal_ids))], ['invoice_journal_id'])
+        return {pos_config['invoice_journal_id'][0] for pos_config in pos_configs}
+
     @api.multi
     def is_journal_pos(self):
         self.ensure_one()
-        try:
-            journal_pos_rec = self.env['pos.config'].search([('invoice_journal_id.id', '=', self.journal_id.id)])
-            return bool(journal_pos_rec)
-        except KeyError:
-            return False
+        return bool(self._get_pos_journal_ids(self.journal_id.ids))
+
+    @api.model
+    @tools.ormcache()
+    def _get_universal_discount_enabled(self):
+        # Cleared by res.company when ks_enable_discount is written
+        return bool(self.env['res.company'].sudo().search_count([('ks_enable_discount', '=', True)]))
 
     @api.model
     def is_universal_discount(self):
         try:
             if 'ks_amount_discount' in self:
-                return bool(self.env['res.company'].search([('ks_enable_discount', '=', True)]))
+                return self._get_universal_discount_enabled()
             else:
                 return False
         except KeyError:
             return False
 
+    @api.model
+    def get_response_vals(self, response, payload):
+        """Values of the invoice fields for an API response"""
+        return {
+            'ei_is_valid': response['is_valid'],
+            'ei_is_restored': response['is_restored'],
+            'ei_algorithm': response['algorithm'],
+            'ei_class': response['class'],
+            'ei_number': response['number'],
+            'ei_uuid': response['uuid'],
+            'ei_issue_date': response['issue_date'],
+            'ei_expedition_date': response['expedition_date'],
+            'ei_zip_key': response['zip_key'],
+            'ei_status_code': response['status_code'],
+            'ei_status_description': response['status_description'],
+            'ei_status_message': response['status_message'],
+            'ei_errors_messages': str(response['errors_messages']),
+            'ei_xml_name': response['xml_name'],
+            'ei_zip_name': response['zip_name'],
+            'ei_signature': response['signature'],
+            'ei_qr_code': response['qr_code'],
+            'ei_qr_data': response['qr_data'],
+            'ei_qr_link': response['qr_link'],
+            'ei_pdf_download_link': response['pdf_download_link'],
+            'ei_xml_base64_bytes': response['xml_base64_bytes'],
+            'ei_application_response_base64_bytes': response['application_response_base64_bytes'],
+            'ei_attached_document_base64_bytes': response['attached_document_base64_bytes'],
+            'ei_pdf_base64_bytes': response['pdf_base64_bytes'],
+            'ei_zip_base64_bytes': response['zip_base64_bytes'],
+            'ei_type_environment': response['type_environment_id'],
+            'ei_payload': payload,
+        }
+
+    @api.depends('ei_qr_data')
+    def _compute_ei_qr_image(self):
+        qr_env = self.env['l10n_co_edi_jorels.qr']
+        for rec in self:
+            rec.ei_qr_image = qr_env.get_image(rec.ei_qr_data)
+
+    @api.depends('ei_payload_data')
+    def _compute_ei_payload(self):
+        for rec in self:
+            rec.ei_payload = decompress_payload(rec.with_context(bin_size=False).ei_payload_data)
+
+    @api.multi
+    def _inverse_ei_payload(self):
+        for rec in self:
+            rec.ei_payload_data = compress_payload(rec.ei_payload)
+
     @api.multi
     def write_response(self, response, payload):
         try:
-            for rec in self:
-                rec.ei_is_valid = response['is_valid']
-                rec.ei_is_restored = response['is_restored']
-                rec.ei_algorithm = response['algorithm']
-                rec.ei_class = response['class']
-                rec.ei_number = response['number']
-                rec.ei_uuid = response['uuid']
-                rec.ei_issue_date = response['issue_date']
-                rec.ei_expedition_date = response['expedition_date']
-                rec.ei_zip_key = response['zip_key']
-                rec.ei_status_code = response['status_code']
-                rec.ei_status_description = response['status_description']
-                rec.ei_status_message = response['status_message']
-                rec.ei_errors_messages = str(response['errors_messages'])
-                rec.ei_xml_name = response['xml_name']
-                rec.ei_zip_name = response['zip_name']
-                rec.ei_signature = response['signature']
-                rec.ei_qr_code = response['qr_code']
-                rec.ei_qr_data = response['qr_data']
-                rec.ei_qr_link = response['qr_link']
-                rec.ei_pdf_download_link = response['pdf_download_link']
-                rec.ei_xml_base64_bytes = response['xml_base64_bytes']
-                rec.ei_application_response_base64_bytes = response['application_response_base64_bytes']
-                rec.ei_attached_document_base64_bytes = response['attached_document_base64_bytes']
-                rec.ei_pdf_base64_bytes = response['pdf_base64_bytes']
-                rec.ei_zip_base64_bytes = response['zip_base64_bytes']
-                rec.ei_type_environment = response['type_environment_id']
-                rec.ei_payload = payload
-
-                # QR code
-                qr = qrcode.QRCode(
-                    version=1,
-                    error_correction=qrcode.constants.ERROR_CORRECT_M,
-                    box_size=2,
-                    border=2,
-                )
-                qr.add_data(rec.ei_qr_data)
-                qr.make(fit=True)
-                img = qr.make_image()
-                temp = BytesIO()
-                img.save(temp, format="PNG")
-                qr_image = base64.b64encode(temp.getvalue())
-                rec.ei_qr_image = qr_image
+            # A single write, so the stored computed fields are recomputed once
+            self.write(self.get_response_vals(response, payload))
         except Exception as e:
             _logger.debug("Write response: %s", e)
 
@@ -363,11 +440,11 @@ class AccountInvoice(models.Model):
                             customer_data['trade_name'] = rec_partner.trade_name
 
                         if rec_partner.country_id:
-                            customer_rec = self.env['l10n_co_edi_jorels.countries'].search(
-                                [('code', '=', rec_partner.country_id.code)]
+                            country_id = self.env['l10n_co_edi_jorels.catalog'].get_id(
+                                'l10n_co_edi_jorels.countries', rec_partner.country_id.code
                             )
-                            if customer_rec:
-                                customer_data['country_code'] = customer_rec.id
+                            if country_id:
+                                customer_data['country_code'] = country_id
                             else:
                                 raise UserError(_("You must assign the client a valid country"))
                         else:
@@ -432,67 +509,105 @@ class AccountInvoice(models.Model):
             "payable_value": payable_amount
         }
 
+    @api.model
+    def _get_ei_tax_data(self, taxes):
+        """Classify every distinct tax once: None for the taxes that are not sent to DIAN"""
+        taxes_data = {}
+        for tax in taxes:
+            if not tax.edi_tax_id.id:
+                raise UserError(_("All taxes must be assigned a tax type (DIAN)."))
+            # The information sent to DIAN should not include the withholdings
+            if tax.edi_tax_type in ('withholding', 'excluded'):
+                taxes_data[tax.id] = None
+            elif tax.amount_type in ('percent', 'fixed'):
+                taxes_data[tax.id] = {
+                    'code': tax.edi_tax_id.id,
+                    'amount_type': tax.amount_type,
+                    'amount': tax.amount,
+                }
+            else:
+                raise UserError(_("Electronic invoicing is not yet compatible with this tax type."))
+        return taxes_data
+
     @api.multi
     def get_ei_lines(self):
+        # Snapshot of the lines, products and taxes of all the invoices, read in a few queries
+        invoice_lines = self.mapped('invoice_line_ids').filtered(lambda line: line.account_id)
+        lines_data = {line['id']: line for line in invoice_lines.read(
+            ['discount', 'price_subtotal', 'quantity', 'name', 'ei_notes', 'product_id', 'invoice_line_tax_ids'],
+            load='_classic_write')}
+
+        products_data = {}
+        for product in invoice_lines.mapped('product_id'):
+            products_data[product.id] = {
+                'code': product.code,
+                'brand_name': product.brand_name,
+                'model_name': product.model_name,
+                'uom_code': product.uom_id.edi_unit_measure_id.id or product.edi_unit_measure_id.id,
+            }
+        taxes_data = self._get_ei_tax_data(invoice_lines.mapped('invoice_line_tax_ids'))
+
         lines = []
         for rec in self:
             for invoice_line_id in rec.invoice_line_ids:
-                if invoice_line_id.account_id:
-                    if not (0 <= invoice_line_id.discount < 100):
+                line_data = lines_data.get(invoice_line_id.id)
+                if line_data:
+                    product_data = products_data.get(line_data['product_id'], {})
+                    line_discount = line_data['discount']
+                    line_quantity = line_data['quantity']
+                    line_subtotal = line_data['price_subtotal']
+
+                    if not (0 <= line_discount < 100):
                         raise UserError(_("The discount must always be greater than or equal to 0 and less than 100."))
 
-                    price_unit = 100.0 * invoice_line_id.price_subtotal / (invoice_line_id.quantity * (
-                            100.0 - invoice_line_id.discount))
+                    price_unit = 100.0 * line_subtotal / (line_quantity * (100.0 - line_discount))
                     # The temporary dictionary of elements that belong to the specific line
                     invoice_temps = {}
                     products = {}
                     allowance_charges = {}
                     tax_totals = {'tax_totals': []}
                     products.update({'price_value': price_unit})
-                    products.update({'base_quantity': invoice_line_id.quantity})
+                    products.update({'base_quantity': line_quantity})
 
-                    if invoice_line_id.product_id.code:
-                        products.update({'product_ref': invoice_line_id.product_id.code})
+                    if product_data.get('code'):
+                        products.update({'product_ref': product_data['code']})
                     else:
                         raise UserError(_("All products must have an internal reference assigned"))
 
                     if rec.is_out_country:
-                        if invoice_line_id.product_id.brand_name:
-                            products.update({'brand_name': invoice_line_id.product_id.brand_name})
+                        if product_data['brand_name']:
+                            products.update({'brand_name': product_data['brand_name']})
                         else:
                             raise UserError(_("Products on export invoices must have a brand name"))
 
-                        if invoice_line_id.product_id.model_name:
-                            products.update({'model_name': invoice_line_id.product_id.model_name})
+                        if product_data['model_name']:
+                            products.update({'model_name': product_data['model_name']})
                         else:
                             raise UserError(_("Products on export invoices must have a model name"))
 
-                    products.update({'description': invoice_line_id.name})
+                    products.update({'description': line_data['name']})
 
-                    if invoice_line_id.ei_notes:
-                        products.update({'notes': [{'text': invoice_line_id.ei_notes}]})
+                    if line_data['ei_notes']:
+                        products.update({'notes': [{'text': line_data['ei_notes']}]})
 
-                    if invoice_line_id.product_id.uom_id.edi_unit_measure_id.id:
-                        products.update({'uom_code': invoice_line_id.product_id.uom_id.edi_unit_measure_id.id})
-                    elif invoice_line_id.product_id.edi_unit_measure_id.id:
-                        # If the setting is used in the Odoo unit of measure, then this field is not required
-                        # However, it is left for compatibility with existing fields
-                        products.update({'uom_code': invoice_line_id.product_id.edi_unit_measure_id.id})
+                    # If the setting is used in the Odoo unit of measure, then the product field is not required
+                    # However, it is left for compatibility with existing fields
+                    if product_data['uom_code']:
+                        products.update({'uom_code': product_data['uom_code']})
                     else:
                         raise UserError(_("All products must be assigned a unit of measure (DIAN)"))
 
-                    products.update({'quantity': invoice_line_id.quantity})
-                    products.update({'line_extension_value': invoice_line_id.price_subtotal})
+                    products.update({'quantity': line_quantity})
+                    products.update({'line_extension_value': line_subtotal})
                     # [4]: Taxpayer adoption standard ('999')
                     products.update({'item_code': 4})
 
                     # Discounts
-                    if invoice_line_id.discount:
+                    if line_discount:
                         discount = True
                         allowance_charges.update({'indicator': False})
-                        amount = invoice_line_id.price_subtotal * invoice_line_id.discount / (
-                                100.0 - invoice_line_id.discount)
-                        base_amount = invoice_line_id.price_subtotal + amount
+                        amount = line_subtotal * line_discount / (100.0 - line_discount)
+                        base_amount = line_subtotal + amount
                         allowance_charge_reason = "Descuento"
                     else:
                         discount = False
@@ -503,42 +618,35 @@ class AccountInvoice(models.Model):
 
                     products.update({'price_code': 1})  # Commercial value ('01')
 
-                    taxable_amount = invoice_line_id.price_subtotal
+                    taxable_amount = line_subtotal
 
                     allowance_charges.update({'base_value': base_amount})
                     allowance_charges.update({'value': amount})
                     allowance_charges.update({'reason': allowance_charge_reason})
 
                     # Calculate tax totals for invoice line
-                    for invoice_line_tax_id in invoice_line_id.invoice_line_tax_ids:
-                        tax_total = {}
-
-                        if invoice_line_tax_id.edi_tax_id.id:
-                            edi_tax_name = invoice_line_tax_id.edi_tax_id.name
-                            tax_name = invoice_line_tax_id.name
-                            # The information sent to DIAN should not include the withholdings
-                            if edi_tax_name[:4] != 'Rete' and tax_name != 'IVA Excluido':
-                                if invoice_line_tax_id.amount_type == 'percent':
-                                    tax_total.update({'code': invoice_line_tax_id.edi_tax_id.id})
-                                    tax_total.update(
-                                        {'tax_value': (taxable_amount * invoice_line_tax_id.amount) / 100.0})
-                                    tax_total.update({'taxable_value': taxable_amount})
-                                    tax_total.update({'percent': invoice_line_tax_id.amount})
-                                    tax_totals['tax_totals'].append(tax_total)
-                                elif invoice_line_tax_id.amount_type == 'fixed':
-                                    tax_total.update({'code': invoice_line_tax_id.edi_tax_id.id})
-                                    tax_total.update(
-                                        {'tax_value': invoice_line_id.quantity * invoice_line_tax_id.amount})
-                                    tax_total.update({'taxable_value': invoice_line_id.quantity})
-                                    # "886","number of international units","NIU"
-                                    tax_total.update({'uom_code': 886})
-                                    tax_total.update({'unit_value': invoice_line_tax_id.amount})
-                                    tax_total.update({'base_uom': "1.000000"})
-                                    tax_totals['tax_totals'].append(tax_total)
-                                else:
-                                    raise UserError(_("Electronic invoicing is not yet compatible with this tax type."))
+                    for tax_id in line_data['invoice_line_tax_ids']:
+                        tax_data = taxes_data[tax_id]
+                        if not tax_data:
+                            continue
+
+                        if tax_data['amount_type'] == 'percent':
+                            tax_totals['tax_totals'].append({
+                                'code': tax_data['code'],
+                                'tax_value': (taxable_amount * tax_data['amount']) / 100.0,
+                                'taxable_value': taxable_amount,
+                                'percent': tax_data['amount'],
+                            })
                         else:
-                            raise UserError(_("All taxes must be assigned a tax type (DIAN)."))
+                            # "886","number of international units","NIU"
+                            tax_totals['tax_totals'].append({
+                                'code': tax_data['code'],
+                                'tax_value': line_quantity * tax_data['amount'],
+                                'taxable_value': line_quantity,
+                                'uom_code': 886,
+                                'unit_value': tax_data['amount'],
+                                'base_uom': "1.000000",
+                            })
 
                     # UPDATE ALL THE ELEMENTS OF THE PRODUCT
                     invoice_temps.update(products)
@@ -609,64 +717,81 @@ class AccountInvoice(models.Model):
         return lines
 
     # Calculation of withholdings, excluded, etc.
-    @api.one
+    @api.multi
     def _compute_amount(self):
         res = super(AccountInvoice, self)._compute_amount()
 
-        amount_tax_withholding = 0
-        amount_tax_no_withholding = 0
-        amount_excluded = 0
-        for tax_line_id in self.tax_line_ids:
-            if tax_line_id.tax_id.edi_tax_id:
-                edi_tax_name = tax_line_id.tax_id.edi_tax_id.name
-                tax_name = tax_line_id.tax_id.name
-                if tax_name == 'IVA Excluido':
-                    amount_excluded = amount_excluded + tax_line_id.base
-                elif edi_tax_name[:4] == 'Rete':
-                    amount_tax_withholding = amount_tax_withholding + tax_line_id.amount_total
-                else:
-                    amount_tax_no_withholding = amount_tax_no_withholding + tax_line_id.amount_total
-            else:
-                tax_name = tax_line_id.tax_id.name
-                if tax_name == 'IVA Excluido':
+        for rec in self:
+            amount_tax_withholding = 0
+            amount_tax_no_withholding = 0
+            amount_excluded = 0
+            for tax_line_id in rec.tax_line_ids:
+                edi_tax_type = tax_line_id.tax_id.edi_tax_type
+                if edi_tax_type == 'excluded':
                     amount_excluded = amount_excluded + tax_line_id.base
-                elif tax_name[:3] == 'Rte':
+                elif edi_tax_type == 'withholding':
                     amount_tax_withholding = amount_tax_withholding + tax_line_id.amount_total
                 else:
                     amount_tax_no_withholding = amount_tax_no_withholding + tax_line_id.amount_total
 
-        self.ei_amount_tax_withholding = amount_tax_withholding
-        self.ei_amount_tax_no_withholding = amount_tax_no_withholding
-        self.ei_amount_total_no_withholding = self.amount_untaxed + self.ei_amount_tax_no_withholding
-        self.ei_amount_excluded = amount_excluded
+            rec.ei_amount_tax_withholding = amount_tax_withholding
+            rec.ei_amount_tax_no_withholding = amount_tax_no_withholding
+            rec.ei_amount_total_no_withholding = rec.amount_untaxed + rec.ei_amount_tax_no_withholding
+            rec.ei_amount_excluded = amount_excluded
 
-        if self.is_universal_discount():
-            if not ('ks_global_tax_rate' in self):
-                self.ks_calculate_discount()
-            sign = self.type in ['in_refund', 'out_refund'] and -1 or 1
-            self.amount_total_company_signed = self.amount_total * sign
-            self.amount_total_signed = self.amount_total * sign
+            if rec.is_universal_discount():
+                if not ('ks_global_tax_rate' in rec):
+                    rec.ks_calculate_discount()
+                sign = rec.type in ['in_refund', 'out_refund'] and -1 or 1
+                rec.amount_total_company_signed = rec.amount_total * sign
+                rec.amount_total_signed = rec.amount_total * sign
 
-            self.ei_amount_total_no_withholding = self.amount_untaxed + \
-                                                  self.ei_amount_tax_no_withholding - \
-                                                  self.ks_amount_discount
+                rec.ei_amount_total_no_withholding = rec.amount_untaxed + \
+                                                     rec.ei_amount_tax_no_withholding - \
+                                                     rec.ks_amount_discount
 
         # Value in letters
-        decimal_part, integer_part = math.modf(self.amount_total)
-        if decimal_part:
-            decimal_part = round(decimal_part * math.pow(10, self.currency_id.decimal_places))
-        if integer_part:
-            lang = self.partner_id.lang if self.partner_id.lang else 'es_CO'
-
-            self.value_letters = num2words(integer_part, lang=lang).upper() + ' ' + \
-                                 self.currency_id.currency_unit_label.upper()
-            if decimal_part:
-                self.value_letters = self.value_letters + ', ' + \
-                                     num2words(decimal_part, lang=lang).upper() + ' ' + \
-                                     self.currency_id.currency_subunit_label.upper() + '.'
+        to_letters = self.filtered(lambda inv: abs(inv.amount_total) >= 1)
+        values = self.env['l10n_co_edi_jorels.amount_words'].get_values_in_words([
+            (rec.amount_total, rec.currency_id, rec.partner_id.lang) for rec in to_letters
+        ])
+        for rec, value in zip(to_letters, values):
+            rec.value_letters = value
 
         return res
 
+    @api.model
+    def get_tax_type_totals(self, domain=None):
+        """Tax base and amount per tax and classification of the invoices of the domain, aggregated in SQL
+
+        :return: list of dicts with edi_tax_type, tax_id, base, amount and invoice_count
+        """
+        self.check_access_rights('read')
+        query = self._where_calc(domain or [])
+        self._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        self._cr.execute("""
+            SELECT tax.edi_tax_type, tax.id, sum(invoice_tax.base), sum(invoice_tax.amount_total),
+                   count(DISTINCT invoice_tax.invoice_id)
+            FROM account_invoice_tax invoice_tax
+            JOIN account_tax tax ON tax.id = invoice_tax.tax_id
+            WHERE invoice_tax.invoice_id IN (SELECT "account_invoice".id FROM %s WHERE %s)
+            GROUP BY tax.edi_tax_type, tax.id
+            ORDER BY tax.edi_tax_type, tax.id
+        """ % (from_clause, where_clause or 'TRUE'), where_params)
+        return [{
+            'edi_tax_type': edi_tax_type,
+            'tax_id': tax_id,
+            'base': base,
+            'amount': amount,
+            'invoice_count': invoice_count,
+        } for edi_tax_type, tax_id, base, amount, invoice_count in self._cr.fetchall()]
+
+    @api.model
+    def get_withholding_totals(self, domain=None):
+        """Total withheld per tax of the invoices of the domain"""
+        return [total for total in self.get_tax_type_totals(domain) if total['edi_tax_type'] == 'withholding']
+
     @api.multi
     def get_ei_payment_form(self):
         for rec in self:
@@ -694,7 +819,8 @@ class AccountInvoice(models.Model):
     @api.multi
     def get_ei_type_document_id(self):
         self.ensure_one()
-        type_documents_env = self.env['l10n_co_edi_jorels.type_documents']
+        catalog = self.env['l10n_co_edi_jorels.catalog']
+        type_documents = 'l10n_co_edi_jorels.type_documents'
         # For now the document type is always
         # Electronic invoicing (Code '01')
         # Export electronic invoicing (Code '02')
@@ -706,28 +832,31 @@ class AccountInvoice(models.Model):
             if type_edi_document == 'invoice':
                 # Sales invoice
                 if not self.journal_id.is_out_country:
-                    type_documents_rec = type_documents_env.search([('code', '=', '01')])
+                    type_documents_rec = catalog.get_record(type_documents, '01')
                 else:
-                    type_documents_rec = type_documents_env.search([('code', '=', '02')])
+                    type_documents_rec = catalog.get_record(type_documents, '02')
             elif type_edi_document == 'credit_note':
                 # Credit note
-                type_documents_rec = type_documents_env.search([('code', '=', '91')])
+                type_documents_rec = catalog.get_record(type_documents, '91')
             elif type_edi_document == 'debit_note':
                 # Debit note
-                type_documents_rec = type_documents_env.search([('code', '=', '92')])
+                type_documents_rec = catalog.get_record(type_documents, '92')
             else:
                 raise UserError(_("This type of document does not need to be sent to DIAN"))
         else:
             raise UserError(_("This type of document does not need to be sent to DIAN"))
 
-        self.ei_type_document_id = type_documents_rec.id
+        # Only write on changes, so the payload fingerprint is kept
+        if self.ei_type_document_id != type_documents_rec:
+            self.ei_type_document_id = type_documents_rec.id
 
         return self.ei_type_document_id.id
 
     @api.multi
     def get_ei_sync(self):
         self.ensure_one()
-        self.ei_sync = self.ei_is_not_test
+        if self.ei_sync != self.ei_is_not_test:
+            self.ei_sync = self.ei_is_not_test
         return self.ei_sync
 
     @api.multi
@@ -841,8 +970,111 @@ class AccountInvoice(models.Model):
         else:
             return operation[self.ei_operation]
 
+    @api.multi
+    def _get_json_request_fingerprint(self):
+        """Hash of the row versions of every record used to build the payload of the invoice.
+
+        The version of a row is its transaction and physical location (xmin, ctid). Every update creates a new
+        one, even several in the same transaction, unlike the write date, which is the start of the transaction.
+        """
+        self.ensure_one()
+        self._cr.execute("""
+            WITH inv AS (SELECT * FROM account_invoice WHERE id = %(id)s),
+            inputs AS (
+                SELECT 'account.invoice' AS model, inv.id, inv.xmin::text || inv.ctid::text AS version
+                FROM account_invoice inv WHERE inv.id = %(id)s
+                UNION
+                SELECT 'res.partner', partner.id, partner.xmin::text || partner.ctid::text
+                FROM inv JOIN res_partner customer ON customer.id = inv.partner_id
+                JOIN res_partner partner ON partner.id IN (customer.id, customer.parent_id)
+                UNION
+                SELECT 'l10n_co_edi_jorels.resolution', resolution.id, resolution.xmin::text || resolution.ctid::text
+                FROM inv JOIN l10n_co_edi_jorels_resolution resolution ON resolution.id = inv.resolution_id
+                UNION
+                SELECT 'account.journal', journal.id, journal.xmin::text || journal.ctid::text
+                FROM inv JOIN account_journal journal ON journal.id = inv.journal_id
+                UNION
+                SELECT 'res.company', company.id, company.xmin::text || company.ctid::text
+                FROM inv JOIN res_company company ON company.id = inv.company_id
+                UNION
+                SELECT 'account.invoice.line', line.id, line.xmin::text || line.ctid::text
+                FROM inv JOIN account_invoice_line line ON line.invoice_id = inv.id
+                UNION
+                SELECT 'product.product', product.id, product.xmin::text || product.ctid::text
+                FROM inv JOIN account_invoice_line line ON line.invoice_id = inv.id
+                JOIN product_product product ON product.id = line.product_id
+                UNION
+                SELECT 'product.template', tmpl.id, tmpl.xmin::text || tmpl.ctid::text
+                FROM inv JOIN account_invoice_line line ON line.invoice_id = inv.id
+                JOIN product_product product ON product.id = line.product_id
+                JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+                UNION
+                SELECT 'uom.uom', uom.id, uom.xmin::text || uom.ctid::text
+                FROM inv JOIN account_invoice_line line ON line.invoice_id = inv.id
+                JOIN product_product product ON product.id = line.product_id
+                JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+                JOIN uom_uom uom ON uom.id = tmpl.uom_id
+                UNION
+                SELECT 'account.tax', tax.id, tax.xmin::text || tax.ctid::text
+                FROM inv JOIN account_invoice_line line ON line.invoice_id = inv.id
+                JOIN account_invoice_line_tax rel ON rel.invoice_line_id = line.id
+                JOIN account_tax tax ON tax.id = rel.tax_id
+                UNION
+                SELECT 'account.invoice.tax', invoice_tax.id, invoice_tax.xmin::text || invoice_tax.ctid::text
+                FROM inv JOIN account_invoice_tax invoice_tax ON invoice_tax.invoice_id = inv.id
+                UNION
+                SELECT 'account.tax', tax.id, tax.xmin::text || tax.ctid::text
+                FROM inv JOIN account_invoice_tax invoice_tax ON invoice_tax.invoice_id = inv.id
+                JOIN account_tax tax ON tax.id = invoice_tax.tax_id
+                UNION
+                SELECT 'res.currency.rate', count(*)::int, max(rate.write_date)::text
+                FROM inv JOIN res_currency_rate rate ON rate.currency_id = inv.currency_id
+                UNION
+                SELECT 'account.invoice.origin', origin.id, origin.xmin::text || origin.ctid::text
+                FROM inv JOIN account_invoice origin ON origin.number = inv.origin
+            )
+            SELECT array_agg(model || ':' || id || ':' || coalesce(version, '') ORDER BY model, id)
+            FROM inputs
+        """, {'id': self.id})
+        return hashlib.sha1(repr(self._cr.fetchone()[0]).encode()).hexdigest()
+
+    @api.model
+    def get_json_request_cache_stats(self):
+        with _payload_cache_lock:
+            return dict(_payload_cache_stats, size=len(_payload_cache))
+
     @api.multi
     def get_json_request(self):
+        """Return the payload of the invoice, reusing the one already built while its inputs have not changed"""
+        for rec in self:
+            key = (self._cr.dbname, rec.id)
+            with _payload_cache_lock:
+                cached = _payload_cache.get(key)
+            # The fingerprint is only compared when there is a payload to reuse
+            if cached and cached[0] == rec._get_json_request_fingerprint():
+                with _payload_cache_lock:
+                    if key in _payload_cache:
+                        _payload_cache.move_to_end(key)
+                    _payload_cache_stats['hits'] += 1
+                return json.loads(cached[1])
+            with _payload_cache_lock:
+                _payload_cache_stats['misses'] += 1
+
+            json_request = rec.build_json_request()
+
+            # Building the payload can update some fields of the invoice
+            fingerprint = rec._get_json_request_fingerprint()
+            with _payload_cache_lock:
+                _payload_cache[key] = (fingerprint, json.dumps(json_request))
+                _payload_cache.move_to_end(key)
+                while len(_payload_cache) > PAYLOAD_CACHE_SIZE:
+                    _payload_cache.popitem(last=False)
+            _logger.debug("Payload cache: %s", _payload_cache_stats)
+
+            return json_request
+
+    @api.multi
+    def build_json_request(self):
         for rec in self:
             # If it is a sales invoice or credit note or debit note.
             if rec.type == 'out_invoice' or rec.type == 'out_refund':
@@ -888,9 +1120,10 @@ class AccountInvoice(models.Model):
                     company_currency_code = rec.company_id.currency_id.name
                     invoice_currency_code = rec.currency_id.name
 
-                    type_currencies_env = self.env['l10n_co_edi_jorels.type_currencies']
-                    company_currency_search = type_currencies_env.search([('code', '=', company_currency_code)])
-                    invoice_currency_search = type_currencies_env.search([('code', '=', invoice_currency_code)])
+                    catalog = self.env['l10n_co_edi_jorels.catalog']
+                    type_currencies = 'l10n_co_edi_jorels.type_currencies'
+                    company_currency_search = catalog.get_record(type_currencies, company_currency_code)
+                    invoice_currency_search = catalog.get_record(type_currencies, invoice_currency_code)
 
                     # The if is to make sure the name in currency_id,
                     # have a match in the code in type_currencies of the DIAN
@@ -958,7 +1191,12 @@ class AccountInvoice(models.Model):
 
                 # Billing reference
                 if billing_reference:
-                    rec.compute_ei_correction_concept_id()
+                    if rec.ei_type_document_id.id == 5:
+                        ei_correction_concept = rec.ei_correction_concept_credit_id
+                    else:
+                        ei_correction_concept = rec.ei_correction_concept_debit_id
+                    if rec.ei_correction_concept_id != ei_correction_concept:
+                        rec.compute_ei_correction_concept_id()
                     if rec.ei_correction_concept_id:
                         json_request["discrepancy"] = {
                             # "reference": None,
@@ -1016,102 +1254,139 @@ class AccountInvoice(models.Model):
         return type_edi_document
 
     @api.multi
-    def validate_dian_generic(self, is_test):
-        for rec in self:
-            if not rec.company_id.ei_enable:
-                continue
+    def get_dian_request(self, is_test):
+        """Return the API path, the payload and the query parameters to send the invoice to DIAN"""
+        self.ensure_one()
+        type_edi_document = self.get_type_edi_document()
+        if type_edi_document == 'none':
+            raise UserError(_("This type of document does not need to be sent to the DIAN"))
 
-            # raise Warning(json.dumps(rec.get_json_request(), indent=2, sort_keys=False))
-            _logger.debug("DIAN Validation Request: %s", json.dumps(rec.get_json_request(), indent=2, sort_keys=False))
+        requests_data = self.get_json_request()
 
-            try:
-                type_edi_document = rec.get_type_edi_document()
-                if type_edi_document != 'none':
-                    requests_data = rec.get_json_request()
+        if self.company_id.api_key:
+            token = self.company_id.api_key
+        else:
+            raise UserError(_("You must configure a token"))
 
-                    if rec.company_id.api_key:
-                        token = rec.company_id.api_key
-                    else:
-                        raise UserError(_("You must configure a token"))
-
-                    api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                               'https://edipo.jorels.com')
-                    params = {'token': token}
-                    header = {
-                        "accept": "application/json",
-                        "Content-Type": "application/json"
-                    }
+        params = {'token': token}
 
-                    if rec.is_out_country:
-                        params['export'] = True
+        if self.is_out_country:
+            params['export'] = True
 
-                    api_url = api_url + "/" + type_edi_document
+        if is_test or not self.ei_is_not_test:
+            if self.company_id.test_set_id:
+                test_set_id = self.company_id.test_set_id
+                params['test_set_id'] = test_set_id
+            else:
+                raise UserError(_("You have not configured a 'TestSetId'."))
 
-                    if is_test or not rec.ei_is_not_test:
-                        if rec.company_id.test_set_id:
-                            test_set_id = rec.company_id.test_set_id
-                            params['test_set_id'] = test_set_id
-                        else:
-                            raise UserError(_("You have not configured a 'TestSetId'."))
+        return "/" + type_edi_document, requests_data, params
+
+    @api.multi
+    def process_dian_response(self, response, requests_data):
+        """Save the API response. Return True if the document is valid, or False if it was only sent to DIAN"""
+        self.ensure_one()
+        self.env['l10n_co_edi_jorels.edipo'].check_response(response)
+
+        if 'is_valid' in response:
+            self.write_response(response, json.dumps(requests_data, indent=2, sort_keys=False))
+            if response['is_valid']:
+                return True
+            elif 'uuid' in response:
+                if response['uuid'] != "":
+                    if not self.ei_is_not_test:
+                        return False
+                    else:
+                        temp_message = {self.ei_status_message, self.ei_errors_messages,
+                                        self.ei_status_description, self.ei_status_code}
+                        raise UserError(str(temp_message))
+                else:
+                    raise UserError(_('A valid UUID was not obtained. Try again.'))
+            else:
+                raise UserError(_('The document could not be validated in DIAN.'))
+        else:
+            raise UserError(_("No logical response was obtained from the API."))
 
-                    _logger.debug('API URL: %s', api_url)
+    @api.multi
+    def validate_dian_generic(self, is_test):
+        edipo_env = self.env['l10n_co_edi_jorels.edipo']
+        # The submission queue sends the documents of the contingency buffer, they must not be queued again
+        contingency = not self._context.get('edipo_no_contingency')
+        to_reconcile = self.browse()
+        for rec in self:
+            if not rec.company_id.ei_enable:
+                continue
 
-                    response = requests.post(api_url,
-                                             json.dumps(requests_data),
-                                             headers=header,
-                                             params=params).json()
-                    _logger.debug('API Response: %s', response)
+            if contingency and not edipo_env.is_api_available():
+                rec.enqueue_dian_submission(is_test)
+                self.env.user.notify_warning(message=_("DIAN is not available at the moment. The document has "
+                                                       "been queued and will be sent automatically."))
+                continue
 
-                    if 'detail' in response:
-                        raise UserError(response['detail'])
-                    if 'message' in response:
-                        if response['message'] == 'Unauthenticated.' or response['message'] == '':
-                            raise UserError(_("Authentication error with the API"))
-                        else:
-                            if 'errors' in response:
-                                raise UserError(response['message'] + '/ errors: ' + str(response['errors']))
-                            else:
-                                raise UserError(response['message'])
-                    elif 'is_valid' in response:
-                        rec.write_response(response, json.dumps(requests_data, indent=2, sort_keys=False))
-                        if response['is_valid']:
-                            self.env.user.notify_success(message=_("The validation at DIAN has been successful."))
-                        elif 'uuid' in response:
-                            if response['uuid'] != "":
-                                if not rec.ei_is_not_test:
-                                    self.env.user.notify_success(message=_("Document sent to DIAN in habilitation."))
-                                else:
-                                    temp_message = {rec.ei_status_message, rec.ei_errors_messages,
-                                                    rec.ei_status_description, rec.ei_status_code}
-                                    raise UserError(str(temp_message))
-                            else:
-                                raise UserError(_('A valid UUID was not obtained. Try again.'))
-                        else:
-                            raise UserError(_('The document could not be validated in DIAN.'))
-                    else:
-                        raise UserError(_("No logical response was obtained from the API."))
+            try:
+                path, requests_data, params = rec.get_dian_request(is_test)
+
+                # raise Warning(json.dumps(requests_data, indent=2, sort_keys=False))
+                _logger.debug("DIAN Validation Request: %s", json.dumps(requests_data, indent=2, sort_keys=False))
+
+                response = self.env['l10n_co_edi_jorels.ledger'].sudo().send_once(
+                    rec.company_id, rec.get_type_edi_document(), rec.number_formatted,
+                    lambda: edipo_env.request('POST', path, requests_data, params), is_test)
+                if rec.process_dian_response(response, requests_data):
+                    self.env.user.notify_success(message=_("The validation at DIAN has been successful."))
                 else:
-                    raise UserError(_("This type of document does not need to be sent to the DIAN"))
+                    self.env.user.notify_success(message=_("Document sent to DIAN in habilitation."))
+            except requests.RequestException as e:
+                if not contingency:
+                    raise UserError(_("Failed to process the request: %s") % e)
+                _logger.warning("The API request failed, the invoice %s is queued: %s", rec.id, e)
+                rec.enqueue_dian_submission(is_test)
+                self.env.user.notify_warning(message=_("DIAN is not available at the moment. The document has "
+                                                       "been queued and will be sent automatically."))
+                continue
             except Exception as e:
                 _logger.debug("Failed to process the request: %s", e)
                 raise UserError(_("Failed to process the request: %s") % e)
 
             if not is_test and not rec.ei_attached_document_base64_bytes:
-                rec.status_document_log()
-                if not rec.ei_attached_document_base64_bytes:
-                    _logger.error('Unable to obtain an attached document.')
+                to_reconcile |= rec
+
+        # The attached documents are requested at once, from the logs
+        if to_reconcile:
+            to_reconcile.reconcile_dian_logs()
+            for rec in to_reconcile.filtered(lambda inv: not inv.ei_attached_document_base64_bytes):
+                _logger.error('Unable to obtain an attached document for the invoice %s.', rec.id)
+
+    @api.multi
+    def enqueue_dian_submission(self, is_test):
+        to_enqueue = self.filtered(lambda inv: inv.company_id.ei_enable)
+        return self.env['l10n_co_edi_jorels.submission'].enqueue(to_enqueue, is_test)
+
+    @api.multi
+    def enqueue_edi_mail(self):
+        """Queue the invoice emails, they are rendered and sent in background"""
+        return self.env['l10n_co_edi_jorels.submission'].enqueue(self, False, job_type='mail')
+
+    @api.multi
+    def _is_dian_queued(self):
+        """The document waits in the submission queue, DIAN has not answered yet"""
+        self.ensure_one()
+        return not self.ei_is_valid and bool(self.submission_ids.filtered(lambda job: job.state == 'pending'))
 
     @api.multi
     def validate_dian(self):
         for rec in self:
             rec.validate_dian_generic(False)
-            rec.write({'state': 'open'})
+            # A queued document stays pending, the queue opens it when DIAN answers
+            if not rec._is_dian_queued():
+                rec.write({'state': 'open'})
 
     @api.multi
     def validate_dian_test(self):
         for rec in self:
             rec.validate_dian_generic(True)
-            rec.write({'state': 'open'})
+            if not rec._is_dian_queued():
+                rec.write({'state': 'open'})
 
     @api.multi
     def skip_validate_dian(self):
@@ -1128,10 +1403,16 @@ class AccountInvoice(models.Model):
     def action_invoice_open(self):
         res = super(AccountInvoice, self).action_invoice_open()
 
-        to_edi = self.filtered(lambda inv: inv.company_id.ei_enable
+        # Company flags and POS journals are resolved once for the whole set
+        company_flags = {company['id']: company for company in self.mapped('company_id').read([
+            'ei_enable', 'is_not_test', 'enable_validate_state', 'enable_mass_send_print',
+            'ei_enable_submission_queue'])}
+        pos_journal_ids = self._get_pos_journal_ids(set(self.mapped('journal_id').ids))
+
+        to_edi = self.filtered(lambda inv: company_flags[inv.company_id.id]['ei_enable']
                                            and inv.type in ('out_invoice', 'out_refund')
                                            and not inv.ei_is_valid
-                                           and not inv.is_journal_pos())
+                                           and inv.journal_id.id not in pos_journal_ids)
         if to_edi:
             # Invoices in DIAN cannot be validated with zero total
             to_paid_invoices = to_edi.filtered(lambda inv: inv.state == 'paid')
@@ -1139,23 +1420,34 @@ class AccountInvoice(models.Model):
                 raise UserError(_('Please check your invoice again. Are you really billing something?'))
 
             # Validate invoices
-            to_electronic_invoices = to_edi.filtered(lambda inv: inv.state == 'open'
-                                                                 and not inv.company_id.enable_validate_state)
+            to_electronic_invoices = to_edi.filtered(
+                lambda inv: inv.state == 'open' and not company_flags[inv.company_id.id]['enable_validate_state'])
             if to_electronic_invoices:
-                to_electronic_invoices.filtered(lambda inv: inv.write({'ei_is_not_test': inv.company_id.is_not_test}))
+                production = to_electronic_invoices.filtered(
+                    lambda inv: company_flags[inv.company_id.id]['is_not_test'])
+                if production:
+                    production.write({'ei_is_not_test': True})
+                if to_electronic_invoices - production:
+                    (to_electronic_invoices - production).write({'ei_is_not_test': False})
+
+                # Invoices sent to DIAN by the submission queue
+                to_queue_invoices = to_electronic_invoices.filtered(
+                    lambda inv: company_flags[inv.company_id.id]['ei_enable_submission_queue'])
+                if to_queue_invoices:
+                    to_queue_invoices.filtered(lambda inv: inv.ei_is_not_test).enqueue_dian_submission(False)
+                    to_queue_invoices.filtered(lambda inv: not inv.ei_is_not_test).enqueue_dian_submission(True)
+                    self.env.user.notify_info(message=_("The invoices have been queued to be sent to DIAN."))
+                    to_electronic_invoices -= to_queue_invoices
 
                 # Production invoices
                 to_production_invoices = to_electronic_invoices.filtered(lambda inv: inv.ei_is_not_test)
                 if to_production_invoices:
                     to_production_invoices.validate_dian_generic(False)
-                    to_mass_send = to_production_invoices.filtered(lambda inv: inv.company_id.enable_mass_send_print)
+                    # The invoices put in the contingency queue are emailed by the queue, once validated
+                    to_mass_send = to_production_invoices.filtered(
+                        lambda inv: company_flags[inv.company_id.id]['enable_mass_send_print'] and inv.ei_is_valid)
                     if to_mass_send:
-                        try:
-                            to_mass_send.mass_send_print()
-                        except Exception as e:
-                            self.env.user.notify_danger(message=_('The invoice email could not be sent'))
-                            _logger.debug("The invoice email could not be sent")
-                            _logger.error('mass_send_print error: %s' % e)
+                        to_mass_send.enqueue_edi_mail()
 
                 # Test invoices
                 to_test_invoices = to_electronic_invoices.filtered(lambda inv: not inv.ei_is_not_test)
@@ -1186,38 +1478,21 @@ class AccountInvoice(models.Model):
                         else:
                             raise UserError(_("You must configure a token"))
 
-                        api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                                   'https://edipo.jorels.com')
                         params = {
                             'token': token,
                             'environment': 1 if rec.ei_is_not_test else 2
                         }
-                        header = {"accept": "application/json", "Content-Type": "application/json"}
 
                         if rec.ei_zip_key:
-                            api_url = api_url + "/zip/" + rec.ei_zip_key
+                            path = "/zip/" + rec.ei_zip_key
                         else:
-                            api_url = api_url + "/document/" + rec.ei_uuid
-
-                        _logger.debug('API URL: %s', api_url)
+                            path = "/document/" + rec.ei_uuid
 
-                        response = requests.post(api_url,
-                                                 json.dumps(requests_data),
-                                                 headers=header,
-                                                 params=params).json()
-                        _logger.debug('API Response: %s', response)
+                        edipo_env = self.env['l10n_co_edi_jorels.edipo']
+                        response = edipo_env.request('POST', path, requests_data, params, idempotent=True)
+                        edipo_env.check_response(response)
 
-                        if 'detail' in response:
-                            raise UserError(response['detail'])
-                        if 'message' in response:
-                            if response['message'] == 'Unauthenticated.' or response['message'] == '':
-                                raise UserError(_("Authentication error with the API"))
-                            else:
-                                if 'errors' in response:
-                                    raise UserError(response['message'] + '/ errors: ' + str(response['errors']))
-                                else:
-                                    raise UserError(response['message'])
-                        elif 'is_valid' in response:
+                        if 'is_valid' in response:
                             rec.write_response(response, json.dumps(requests_data, indent=2, sort_keys=False))
                             if response['is_valid']:
                                 self.env.user.notify_info(message=_("Validation in DIAN has been successful."))
@@ -1243,6 +1518,107 @@ class AccountInvoice(models.Model):
                 _logger.debug("Failed to process the request: %s", e)
                 raise UserError(_("Failed to process the request: %s") % e)
 
+    @api.model
+    def _get_status_poll_domain(self):
+        return [
+            ('type', 'in', ('out_invoice', 'out_refund')),
+            ('state', 'not in', ('draft', 'cancel')),
+            ('company_id.ei_enable', '=', True),
+            ('ei_is_valid', '=', False),
+            ('ei_status_code', '!=', '99'),
+            '|', ('ei_zip_key', '!=', False), ('ei_uuid', '!=', False),
+        ]
+
+    @api.multi
+    def _get_status_poll_request(self):
+        self.ensure_one()
+        if not self.company_id.api_key:
+            return None
+        params = {
+            'token': self.company_id.api_key,
+            'environment': 1 if self.ei_is_not_test else 2
+        }
+        if self.ei_zip_key:
+            return "/zip/" + self.ei_zip_key, params
+        return "/document/" + self.ei_uuid, params
+
+    @api.multi
+    def _apply_status_poll_response(self, response):
+        self.ensure_one()
+        if 'is_valid' not in response:
+            return False
+        self.write_response(response, self.ei_payload)
+        # 99: Rejected by DIAN
+        return self.ei_is_valid or self.ei_status_code == '99'
+
+    @api.model
+    def _get_log_vals(self, log):
+        """Invoice values of a DIAN log, only the values returned by the log are updated"""
+        vals = {'ei_is_valid': log['is_valid']}
+        for field_name, key in LOG_FIELDS:
+            if log.get(key):
+                vals[field_name] = log[key]
+        return vals
+
+    @api.model
+    def _get_newest_valid_log(self, logs):
+        valid_logs = [log for log in logs if log.get('is_valid')]
+        if not valid_logs:
+            return None
+        # On equal dates, the first log returned by the API is kept
+        return max(valid_logs, key=lambda log: log.get('issue_date') or '')
+
+    @api.multi
+    def reconcile_dian_logs(self):
+        """Query the DIAN logs of the invoices concurrently and apply the newest valid log of each one
+
+        :return: list of (invoice_id, result, message), the result is one of
+            'applied' (valid at DIAN but not locally), 'restored' (the missing artifacts were restored),
+            'not_found' (valid locally but not at DIAN), 'not_valid' or 'error'
+        """
+        results = []
+        calls = []
+        for rec in self:
+            if not rec.company_id.ei_enable:
+                continue
+            if not rec.number_formatted:
+                results.append((rec.id, 'error', _("A number is required to verify the status of the document.")))
+            elif not rec.company_id.api_key:
+                results.append((rec.id, 'error', _("You must configure a token")))
+            else:
+                calls.append((rec.id, 'POST', "/logs/" + rec.number_formatted, {}, {'token': rec.company_id.api_key}))
+
+        edipo_env = self.env['l10n_co_edi_jorels.edipo']
+        responses = edipo_env.request_many(calls, idempotent=True)
+        for invoice_id, response in responses.items():
+            rec = self.browse(invoice_id)
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                if isinstance(response, dict):
+                    edipo_env.check_response(response)
+                    raise UserError(_("Unexpected response from the API: %s") % response)
+
+                log = self._get_newest_valid_log(response or [])
+                if log is None:
+                    if rec.ei_is_valid:
+                        results.append((invoice_id, 'not_found', _("The document is not valid at DIAN.")))
+                    else:
+                        results.append((invoice_id, 'not_valid', _("The document has not been validated.")))
+                    continue
+
+                was_valid = rec.ei_is_valid
+                with self._cr.savepoint():
+                    rec.write(rec._get_log_vals(log))
+                    # As in the validation of a single invoice, a document valid at DIAN is no longer pending
+                    if rec.state == 'validate':
+                        rec.write({'state': 'open'})
+                results.append((invoice_id, 'restored' if was_valid else 'applied', log.get('uuid') or False))
+            except Exception as e:
+                _logger.debug("DIAN log of the invoice %s could not be applied: %s", invoice_id, e)
+                results.append((invoice_id, 'error', str(e)))
+        return results
+
     @api.multi
     def status_document_log(self):
         for rec in self:
@@ -1266,88 +1642,21 @@ class AccountInvoice(models.Model):
                         else:
                             raise UserError(_("You must configure a token"))
 
-                        api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                                   'https://edipo.jorels.com')
                         params = {'token': token}
-                        header = {"accept": "application/json", "Content-Type": "application/json"}
-
-                        api_url = api_url + "/logs/" + rec.number_formatted
-
-                        _logger.debug('API URL: %s', api_url)
 
-                        response = requests.post(api_url,
-                                                 json.dumps(requests_data),
-                                                 headers=header,
-                                                 params=params).json()
-                        _logger.debug('API Response: %s', response)
+                        response = self.env['l10n_co_edi_jorels.edipo'].request(
+                            'POST', "/logs/" + rec.number_formatted, requests_data, params, idempotent=True)
 
                         if 'detail' in response:
                             raise UserError(response['detail'])
                         if 'message' in response:
-                            if response['message'] == 'Unauthenticated.' or response['message'] == '':
-                                self.env.user.notify_warning(message=_("Authentication error with the API"))
-                                _logger.debug("Authentication error with the API")
-                            else:
-                                if 'errors' in response:
-                                    self.env.user.notify_warning(
-                                        message=response['message'] + '/ errors: ' + str(response['errors']))
-                                    _logger.debug(response['message'] + '/ errors: ' + str(response['errors']))
-                                else:
-                                    self.env.user.notify_warning(message=response['message'])
-                                    _logger.debug(response['message'])
+                            message = error_message(response)
+                            self.env.user.notify_warning(message=message)
+                            _logger.debug(message)
                         elif response and ('is_valid' in response[0]):
-                            success = False
-                            for log in response:
-                                if log['is_valid']:
-                                    json_request = json.loads(json.dumps(log))
-                                    rec.ei_is_valid = json_request['is_valid']
-                                    if json_request['algorithm']:
-                                        rec.ei_algorithm = json_request['algorithm']
-                                    if json_request['uuid']:
-                                        rec.ei_uuid = json_request['uuid']
-                                    if json_request['issue_date']:
-                                        rec.ei_issue_date = json_request['issue_date']
-                                    if json_request['zip_key']:
-                                        rec.ei_zip_key = json_request['zip_key']
-                                    if json_request['xml_name']:
-                                        rec.ei_xml_name = json_request['xml_name']
-                                    if json_request['zip_name']:
-                                        rec.ei_zip_name = json_request['zip_name']
-                                    if json_request['xml_base64_bytes']:
-                                        rec.ei_xml_base64_bytes = json_request['xml_base64_bytes']
-                                    if json_request['qr_data']:
-                                        rec.ei_qr_data = json_request['qr_data']
-                                    if json_request['application_response_base64_bytes']:
-                                        rec.ei_application_response_base64_bytes = json_request[
-                                            'application_response_base64_bytes']
-                                    if json_request['attached_document_base64_bytes']:
-                                        rec.ei_attached_document_base64_bytes = json_request[
-                                            'attached_document_base64_bytes']
-                                    if json_request['pdf_base64_bytes']:
-                                        rec.ei_pdf_base64_bytes = json_request['pdf_base64_bytes']
-                                    if json_request['zip_base64_bytes']:
-                                        rec.ei_zip_base64_bytes = json_request['zip_base64_bytes']
-                                    if json_request['signature']:
-                                        rec.ei_signature = json_request['signature']
-
-                                        # QR code
-                                        qr = qrcode.QRCode(
-                                            version=1,
-                                            error_correction=qrcode.constants.ERROR_CORRECT_M,
-                                            box_size=2,
-                                            border=2,
-                                        )
-                                        qr.add_data(rec.ei_qr_data)
-                                        qr.make(fit=True)
-                                        img = qr.make_image()
-                                        temp = BytesIO()
-                                        img.save(temp, format="PNG")
-                                        qr_image = base64.b64encode(temp.getvalue())
-                                        rec.ei_qr_image = qr_image
-
-                                    success = True
-                                    break
-                            if success:
+                            log = rec._get_newest_valid_log(response)
+                            if log:
+                                rec.write(rec._get_log_vals(log))
                                 self.env.user.notify_info(message=_("Validation in DIAN has been successful."))
                                 _logger.debug("Validation in DIAN has been successful.")
                             else:
@@ -1367,23 +1676,78 @@ class AccountInvoice(models.Model):
                 self.env.user.notify_warning(message=_("Failed to process the request"))
                 _logger.debug("Failed to process the request: %s", e)
 
+    @api.model
+    def _parse_attached_document(self, file):
+        """Read the header values of an AttachedDocument with a streaming parser.
+
+        The payable amount is read from the invoice embedded in the first attachment description.
+        """
+        values = {}
+        description = None
+        for event, element in etree.iterparse(file, events=('end',), resolve_entities=False, no_network=True,
+                                              huge_tree=True):
+            tag = etree.QName(element).localname
+            parent = element.getparent()
+            # Only the values of the header, not the ones of the parent document references
+            if parent is not None and parent.getparent() is None:
+                if tag in ('ParentDocumentID', 'UUID', 'IssueDate') and tag not in values:
+                    values[tag] = (element.text or '').strip()
+            # UUID (CUFE/CUDE) of the validated document
+            if tag == 'UUID' and parent is not None and etree.QName(parent).localname == 'DocumentReference':
+                values.setdefault('ParentUUID', (element.text or '').strip())
+            if tag == 'Description' and description is None and element.text and '<' in element.text:
+                description = element.text
+            # Free the memory of the elements already read
+            if parent is not None and parent.getparent() is None:
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+
+        if description:
+            try:
+                for event, element in etree.iterparse(BytesIO(description.strip().encode()), events=('end',),
+                                                      resolve_entities=False, no_network=True, huge_tree=True):
+                    if etree.QName(element).localname == 'PayableAmount' and \
+                            etree.QName(element.getparent()).localname == 'LegalMonetaryTotal':
+                        values['PayableAmount'] = float(element.text)
+                        break
+            except (etree.XMLSyntaxError, ValueError) as e:
+                _logger.debug("The attached document has not a valid embedded document: %s", e)
+        return values
+
     @api.depends('ei_attached_document_base64_bytes')
+    def _compute_attached_document_data(self):
+        for rec in self:
+            values = {}
+            if rec.ei_attached_document_base64_bytes:
+                try:
+                    with BytesIO(base64.b64decode(rec.ei_attached_document_base64_bytes)) as file:
+                        values = rec._parse_attached_document(file)
+                except (etree.XMLSyntaxError, ValueError) as e:
+                    _logger.debug("Unable to read the attached document of %s: %s", rec.id, e)
+            rec.ei_attached_parent_document_id = values.get('ParentDocumentID')
+            rec.ei_attached_uuid = values.get('ParentUUID') or values.get('UUID')
+            rec.ei_attached_issue_date = values.get('IssueDate') or False
+            rec.ei_attached_payable_amount = values.get('PayableAmount', 0.0)
+
+    @api.depends('ei_attached_parent_document_id', 'number_formatted')
     def _is_attached_document_matched(self):
         for rec in self:
             if not rec.company_id.ei_enable:
                 continue
 
-            if rec.ei_attached_document_base64_bytes:
-                with BytesIO(base64.b64decode(rec.ei_attached_document_base64_bytes)) as file:
-                    search_ok = False
-                    for line in file:
-                        search_string = '<cbc:ParentDocumentID>' + rec.number_formatted + '</cbc:ParentDocumentID>'
-                        if search_string in str(line):
-                            search_ok = True
-                            break
-                    rec.is_attached_document_matched = search_ok
-            else:
-                rec.is_attached_document_matched = False
+            rec.is_attached_document_matched = bool(rec.ei_attached_parent_document_id) and \
+                rec.ei_attached_parent_document_id == rec.number_formatted
+
+    @api.multi
+    def action_review_attached_document(self):
+        self._compute_attached_document_data()
+        self._is_attached_document_matched()
+
+    @api.model
+    def search_by_cufe(self, cufe):
+        """Invoice with the UUID (CUFE/CUDE) of the DIAN"""
+        return self.search(['|', ('ei_uuid', '=', cufe), ('ei_attached_uuid', '=', cufe)], limit=1)
 
     @api.multi
     def message_update(self, msg_dict, update_vals=None):
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import logging
+
+from odoo import api, fields, models, _
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountInvoiceReconcileDian(models.TransientModel):
+    _name = 'account.invoice.reconcile.dian'
+    _description = "Reconcile invoices with the DIAN logs"
+
+    date_from = fields.Date(string="From", required=True,
+                            default=lambda self: fields.Date.context_today(self).replace(day=1))
+    date_to = fields.Date(string="To", required=True, default=fields.Date.context_today)
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('done', 'Done'),
+    ], string="Status", default='draft')
+    checked_count = fields.Integer(string="Checked", readonly=True)
+    mismatch_count = fields.Integer(string="Mismatches", readonly=True)
+    restored_count = fields.Integer(string="Restored", readonly=True)
+    failure_count = fields.Integer(string="Failed", readonly=True)
+    line_ids = fields.One2many(comodel_name='account.invoice.reconcile.dian.line', inverse_name='wizard_id',
+                               string="Results", readonly=True)
+
+    @api.multi
+    def _get_invoices_to_reconcile(self):
+        """Invoices of the period which are not valid, or valid without their attached document"""
+        self.ensure_one()
+        invoices = self.env['account.invoice'].search([
+            ('type', 'in', ('out_invoice', 'out_refund')),
+            ('state', 'in', ('validate', 'open', 'in_payment', 'paid')),
+            ('date_invoice', '>=', self.date_from),
+            ('date_invoice', '<=', self.date_to),
+            ('company_id.ei_enable', '=', True),
+        ])
+        if not invoices:
+            return invoices
+
+        self._cr.execute("""
+            SELECT res_id FROM ir_attachment
+            WHERE res_model = 'account.invoice' AND res_field = 'ei_attached_document_base64_bytes'
+              AND res_id IN %s
+        """, (tuple(invoices.ids),))
+        with_document = {row[0] for row in self._cr.fetchall()}
+        return invoices.filtered(lambda inv: not inv.ei_is_valid or inv.id not in with_document)
+
+    @api.multi
+    def action_reconcile(self):
+        self.ensure_one()
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.bulk_batch', 50))
+
+        invoices = self._get_invoices_to_reconcile()
+        results = []
+        for invoice_ids in split_every(batch_size, invoices.ids):
+            results += self.env['account.invoice'].browse(invoice_ids).reconcile_dian_logs()
+            # The restored documents must not be lost if a later batch fails
+            self._cr.commit()
+
+        self.write({
+            'state': 'done',
+            'checked_count': len(invoices),
+            'mismatch_count': len([r for r in results if r[1] in ('applied', 'not_found')]),
+            'restored_count': len([r for r in results if r[1] == 'restored']),
+            'failure_count': len([r for r in results if r[1] == 'error']),
+            # Documents which are not valid at DIAN nor locally are consistent, they are not reported
+            'line_ids': [(0, 0, {
+                'invoice_id': invoice_id,
+                'result': result,
+                'message': message,
+            }) for invoice_id, result, message in results if result != 'not_valid'],
+        })
+
+        message = _("DIAN reconciliation: %s checked, %s mismatches, %s restored, %s failed.") % (
+            self.checked_count, self.mismatch_count, self.restored_count, self.failure_count)
+        if self.mismatch_count or self.failure_count:
+            self.env.user.notify_warning(message=message)
+        else:
+            self.env.user.notify_success(message=message)
+
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'view_type': 'form',
+            'target': 'new',
+        }
+
+
+class AccountInvoiceReconcileDianLine(models.TransientModel):
+    _name = 'account.invoice.reconcile.dian.line'
+    _description = "Reconcile invoices with the DIAN logs result"
+
+    wizard_id = fields.Many2one(comodel_name='account.invoice.reconcile.dian', string="Wizard", required=True,
+                                ondelete='cascade')
+    invoice_id = fields.Many2one(comodel_name='account.invoice', string="Invoice", readonly=True)
+    result = fields.Selection([
+        ('applied', 'Valid at DIAN but not locally'),
+        ('not_found', 'Valid locally but not at DIAN'),
+        ('restored', 'Documents restored'),
+        ('not_valid', 'Not valid'),
+        ('error', 'Error'),
+    ], string="Result", readonly=True)
+    message = fields.Text(string="Message", readonly=True)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import logging
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountInvoiceValidateDian(models.TransientModel):
+    _name = 'account.invoice.validate.dian'
+    _description = "Validate invoices at DIAN"
+
+    @api.model
+    def _default_invoice_ids(self):
+        if self._context.get('active_model') != 'account.invoice':
+            return []
+        invoices = self.env['account.invoice'].browse(self._context.get('active_ids', []))
+        return invoices.filtered(lambda inv: inv.type in ('out_invoice', 'out_refund')
+                                 and inv.state in ('validate', 'open')
+                                 and not inv.ei_is_valid).ids
+
+    invoice_ids = fields.Many2many(comodel_name='account.invoice', string="Invoices",
+                                   default=lambda self: self._default_invoice_ids())
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('done', 'Done'),
+    ], string="Status", default='draft')
+    success_count = fields.Integer(string="Validated", readonly=True)
+    sent_count = fields.Integer(string="Sent in habilitation", readonly=True)
+    failure_count = fields.Integer(string="Failed", readonly=True)
+    line_ids = fields.One2many(comodel_name='account.invoice.validate.dian.line', inverse_name='wizard_id',
+                               string="Results", readonly=True)
+
+    @api.multi
+    def action_validate(self):
+        self.ensure_one()
+        edipo_env = self.env['l10n_co_edi_jorels.edipo']
+        ledger_env = self.env['l10n_co_edi_jorels.ledger'].sudo()
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.bulk_batch', 50))
+
+        invoices = self.invoice_ids.filtered(lambda inv: inv.company_id.ei_enable
+                                             and inv.type in ('out_invoice', 'out_refund')
+                                             and inv.state in ('validate', 'open')
+                                             and not inv.ei_is_valid)
+        results = []
+        for invoice_ids in split_every(batch_size, invoices.ids):
+            # Payloads are built in this transaction, only the HTTP requests run in parallel
+            calls = []
+            payloads = {}
+            entries = {}
+            responses = {}
+            for invoice in self.env['account.invoice'].browse(invoice_ids):
+                try:
+                    with self._cr.savepoint():
+                        path, requests_data, params = invoice.get_dian_request(False)
+                        # Locked until the batch is committed: no other worker sends the same document meanwhile
+                        entry = ledger_env._claim(invoice.company_id, invoice.get_type_edi_document(),
+                                                  invoice.number_formatted)
+                        if not entry:
+                            raise UserError(_("The document %s is already being sent to DIAN. Check its status "
+                                              "in a moment.") % invoice.number_formatted)
+                    payloads[invoice.id] = requests_data
+                    valid_response = entry.get_valid_response()
+                    if valid_response is not None:
+                        responses[invoice.id] = valid_response
+                    else:
+                        entries[invoice.id] = entry
+                        calls.append((invoice.id, 'POST', path, requests_data, params))
+                except Exception as e:
+                    results.append((invoice.id, 'error', str(e)))
+
+            responses.update(edipo_env.request_many(calls))
+            to_reconcile = self.env['account.invoice']
+
+            # The DIAN answers are committed in the ledger before they are processed, so they are kept even if
+            # the processing of the batch fails
+            for invoice_id, entry in entries.items():
+                response = responses.get(invoice_id)
+                if response is not None and not isinstance(response, Exception):
+                    entry.save_response(response)
+            self._cr.commit()
+
+            for invoice_id, response in responses.items():
+                invoice = self.env['account.invoice'].browse(invoice_id)
+                try:
+                    if isinstance(response, Exception):
+                        raise response
+                    with self._cr.savepoint():
+                        is_valid = invoice.process_dian_response(response, payloads[invoice_id])
+                        if invoice.state == 'validate':
+                            invoice.write({'state': 'open'})
+                    results.append((invoice_id, 'valid' if is_valid else 'sent', invoice.ei_status_description))
+                    if not invoice.ei_attached_document_base64_bytes:
+                        to_reconcile |= invoice
+                except Exception as e:
+                    _logger.debug("Failed to process the request: %s", e)
+                    results.append((invoice_id, 'error', str(e)))
+
+            # As in the single invoice validation, the missing attached documents are requested from the logs.
+            # Writing them parses the AttachedDocument into the invoice.
+            if to_reconcile:
+                to_reconcile.reconcile_dian_logs()
+                for invoice in to_reconcile.filtered(lambda inv: not inv.ei_attached_document_base64_bytes):
+                    _logger.error('Unable to obtain an attached document for the invoice %s.', invoice.id)
+
+            # The documents already sent to DIAN must not be lost if a later batch fails
+            self._cr.commit()
+
+        self.write({
+            'state': 'done',
+            'success_count': len([r for r in results if r[1] == 'valid']),
+            'sent_count': len([r for r in results if r[1] == 'sent']),
+            'failure_count': len([r for r in results if r[1] == 'error']),
+            'line_ids': [(0, 0, {
+                'invoice_id': invoice_id,
+                'result': result,
+                'message': message,
+            }) for invoice_id, result, message in results],
+        })
+
+        message = _("DIAN validation: %s valid, %s sent in habilitation, %s failed.") % (
+            self.success_count, self.sent_count, self.failure_count)
+        if self.failure_count:
+            self.env.user.notify_warning(message=message)
+        else:
+            self.env.user.notify_success(message=message)
+
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'view_type': 'form',
+            'target': 'new',
+        }
+
+
+class AccountInvoiceValidateDianLine(models.TransientModel):
+    _name = 'account.invoice.validate.dian.line'
+    _description = "Validate invoices at DIAN result"
+
+    wizard_id = fields.Many2one(comodel_name='account.invoice.validate.dian', string="Wizard", required=True,
+                                ondelete='cascade')
+    invoice_id = fields.Many2one(comodel_name='account.invoice', string="Invoice", readonly=True)
+    result = fields.Selection([
+        ('valid', 'Valid'),
+        ('sent', 'Sent in habilitation'),
+        ('error', 'Error'),
+    ], string="Result", readonly=True)
+    message = fields.Text(string="Message", readonly=True)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import math
+from functools import lru_cache
+
+from num2words import num2words
+from odoo import api, models
+
+
+@lru_cache(maxsize=4096)
+def value_in_words(integer_part, decimal_part, lang, unit_label, subunit_label):
+    """Amount in capital letters, e.g. 'MIL CIEN PESOS, CINCUENTA CENTAVOS.'"""
+    if not integer_part:
+        return False
+    value = num2words(integer_part, lang=lang).upper() + ' ' + unit_label.upper()
+    if decimal_part:
+        value = value + ', ' + num2words(decimal_part, lang=lang).upper() + ' ' + subunit_label.upper() + '.'
+    return value
+
+
+class AmountWords(models.AbstractModel):
+    _name = "l10n_co_edi_jorels.amount_words"
+    _description = "Amounts in words"
+
+    @api.model
+    def get_value_in_words(self, amount, currency, lang=None):
+        decimal_part, integer_part = math.modf(amount)
+        if decimal_part:
+            decimal_part = round(decimal_part * math.pow(10, currency.decimal_places))
+        return value_in_words(int(integer_part), int(decimal_part), lang or 'es_CO',
+                              currency.currency_unit_label or '', currency.currency_subunit_label or '')
+
+    @api.model
+    def get_values_in_words(self, items):
+        """Batch version of get_value_in_words
+
+        :param items: list of (amount, currency, lang)
+        :return: list with the amount in words of each item
+        """
+        return [self.get_value_in_words(amount, currency, lang) for amount, currency, lang in items]
+
+    @api.model
+    def get_cache_info(self):
+        return value_in_words.cache_info()._asdict()
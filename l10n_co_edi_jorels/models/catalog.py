@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import logging
+
+from odoo import api, models, tools
+
+_logger = logging.getLogger(__name__)
+
+
+class Catalog(models.AbstractModel):
+    _name = "l10n_co_edi_jorels.catalog"
+    _description = "Listings catalog"
+
+    # The listings are read-only and are only loaded with init_csv_data, which
+    # calls clear_caches(). That invalidation is signaled through the registry,
+    # so every worker reloads the catalog on its next request.
+    @api.model
+    @tools.ormcache('model_name')
+    def _get_catalog(self, model_name):
+        model = self.env[model_name].sudo()
+        has_code = 'code' in model._fields
+        self.env.cr.execute(
+            "SELECT id, name, %s FROM %s ORDER BY id" % ('code' if has_code else 'NULL', model._table)
+        )
+        names = {}
+        codes = {}
+        for record_id, name, code in self.env.cr.fetchall():
+            names[record_id] = name
+            # With duplicated codes, the lowest id wins
+            if code is not None:
+                codes.setdefault(code, record_id)
+        _logger.debug("Catalog %s loaded with %s records", model_name, len(names))
+        return names, codes
+
+    @api.model
+    def get_id(self, model_name, code):
+        """Id of the listing record with the given code, or False"""
+        return self._get_catalog(model_name)[1].get(code, False)
+
+    @api.model
+    def get_record(self, model_name, code):
+        """Listing record with the given code, or an empty recordset"""
+        return self.env[model_name].browse(self.get_id(model_name, code))
+
+    @api.model
+    def get_name(self, model_name, record_id):
+        """Name of the listing record with the given id, or None"""
+        return self._get_catalog(model_name)[0].get(record_id)
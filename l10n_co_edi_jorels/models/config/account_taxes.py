@@ -20,10 +20,27 @@
 # email: info@jorels.com
 #
 
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class AccountTax(models.Model):
     _inherit = "account.tax"
 
     edi_tax_id = fields.Many2one('l10n_co_edi_jorels.taxes', string="Tax type (DIAN)", ondelete='RESTRICT')
+    # It is only recomputed when the DIAN tax changes, so renaming the tax keeps its classification
+    edi_tax_type = fields.Selection([
+        ('regular', 'Regular'),
+        ('withholding', 'Withholding'),
+        ('excluded', 'Excluded'),
+    ], string="Tax classification (DIAN)", compute='_compute_edi_tax_type', store=True, readonly=False, index=True,
+        help="Withholdings and excluded taxes are not sent to DIAN as line taxes")
+
+    @api.depends('edi_tax_id')
+    def _compute_edi_tax_type(self):
+        for rec in self:
+            if rec.name == 'IVA Excluido':
+                rec.edi_tax_type = 'excluded'
+            elif rec.edi_tax_id:
+                rec.edi_tax_type = 'withholding' if rec.edi_tax_id.name[:4] == 'Rete' else 'regular'
+            else:
+                rec.edi_tax_type = 'withholding' if (rec.name or '')[:3] == 'Rte' else 'regular'
@@ -23,7 +23,6 @@
 import json
 import logging
 
-import requests
 from odoo import api, fields, models, tools, _
 
 _logger = logging.getLogger(__name__)
@@ -77,6 +76,9 @@ class ResCompany(models.Model):
                                            default=True)
     enable_mass_send_print = fields.Boolean(string="Automatic invoice email when validating (In production)",
                                             default=False)
+    ei_mail_template_id = fields.Many2one('mail.template', string="Invoice email template",
+                                          domain=[('model', '=', 'account.invoice')])
+    ei_enable_submission_queue = fields.Boolean(string="Send invoices to DIAN in background", default=False)
 
     # Report
     report_custom_text = fields.Html(string="Header text")
@@ -84,6 +86,10 @@ class ResCompany(models.Model):
 
     ei_include_pdf_attachment = fields.Boolean(string="Include PDF attachment on electronic invoice email",
                                                default=True)
+    ei_pdf_source = fields.Selection([
+        ('report', 'Odoo report'),
+        ('dian', 'DIAN PDF')
+    ], string="Electronic invoice PDF", default='report', required=True)
 
     # Enable/disable electronic invoicing for company
     ei_enable = fields.Boolean(string="Enable electronic invoicing for this company", default=True)
@@ -236,26 +242,16 @@ class ResCompany(models.Model):
                               json.dumps(requests_data, indent=2, sort_keys=False))
 
                 token = rec.api_key
-                api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                           'https://edipo.jorels.com')
                 params = {'token': token}
-                header = {"accept": "application/json", "Content-Type": "application/json"}
-                api_url = api_url + "/environment"
-                response = requests.put(api_url,
-                                        json.dumps(requests_data),
-                                        headers=header,
-                                        params=params).json()
-                _logger.debug('API Response PUT environment: %s', response)
+                edipo_env = self.env['l10n_co_edi_jorels.edipo']
+                response = edipo_env.request('PUT', "/environment", requests_data, params)
 
                 if 'detail' in response:
                     raise Warning(response['detail'])
                 if 'message' in response:
                     rec.env.user.notify_info(message=response['message'])
 
-                response = requests.get(api_url,
-                                        headers=header,
-                                        params=params).json()
-                _logger.debug('API Response GET environment: %s', response)
+                response = edipo_env.request('GET', "/environment", params=params, idempotent=True)
 
                 if 'type_environment_id' in response:
                     if environment == response['type_environment_id']:
@@ -279,4 +275,15 @@ class ResCompany(models.Model):
                     if not self.update_environment(environment):
                         vals['is_not_test'] = not vals['is_not_test']
 
-        return super(ResCompany, self).write(vals)
+        res = super(ResCompany, self).write(vals)
+        if 'ks_enable_discount' in vals:
+            # The universal discount capability is cached per registry
+            self.clear_caches()
+        return res
+
+    @api.model
+    def create(self, vals):
+        res = super(ResCompany, self).create(vals)
+        if vals.get('ks_enable_discount'):
+            self.clear_caches()
+        return res
@@ -23,7 +23,6 @@
 import json
 import logging
 
-import requests
 from odoo import api, fields, models, _
 from odoo.exceptions import Warning
 
@@ -46,6 +45,11 @@ class ResConfigSettings(models.TransientModel):
     enable_mass_send_print = fields.Boolean(related="company_id.enable_mass_send_print",
                                             string="Automatic invoice email when validating (In production)",
                                             default=False, readonly=False)
+    ei_mail_template_id = fields.Many2one(related="company_id.ei_mail_template_id",
+                                          string="Invoice email template", readonly=False)
+    ei_enable_submission_queue = fields.Boolean(related="company_id.ei_enable_submission_queue",
+                                                string="Send invoices to DIAN in background",
+                                                default=False, readonly=False)
 
     # Report
     report_custom_text = fields.Html(related="company_id.report_custom_text", string="Header text", readonly=False)
@@ -54,6 +58,8 @@ class ResConfigSettings(models.TransientModel):
     ei_include_pdf_attachment = fields.Boolean(related="company_id.ei_include_pdf_attachment",
                                                string="Include PDF attachment on electronic invoice email",
                                                default=True, readonly=False)
+    ei_pdf_source = fields.Selection(related="company_id.ei_pdf_source", string="Electronic invoice PDF",
+                                     readonly=False)
 
     # Enable/disable electronic invoicing for company
     ei_enable = fields.Boolean(related="company_id.ei_enable",
@@ -71,97 +77,9 @@ class ResConfigSettings(models.TransientModel):
             }
 
         try:
-            token = str(self.env.user.company_id.api_key)
-            api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                       'https://edipo.jorels.com')
-            params = {'token': token}
-            header = {"accept": "application/json", "Content-Type": "application/json"}
-            api_url = api_url + "/resolutions"
-            response = requests.get(api_url,
-                                    headers=header,
-                                    params=params).json()
-            _logger.debug('API Response: %s', response)
-
-            if 'detail' in response:
-                raise Warning(response['detail'])
-            if 'message' in response:
-                if response['message'] == 'Unauthenticated.' or response['message'] == '':
-                    raise Warning(_('Unable to authenticate with the API. Please check your API key and try again.'))
-                else:
-                    raise Warning(response['message'])
-            else:
-                # Now create new resolutions
-                for resolution in response:
-                    if resolution['resolution_date']:
-                        if int(resolution['resolution_date'].split('-')[0]) < 2000:
-                            resolution['resolution_date'] = "'2000-01-01'"
-                        else:
-                            resolution['resolution_date'] = "'" + resolution['resolution_date'] + "'"
-                    else:
-                        resolution['resolution_date'] = 'NULL'
-
-                    if resolution['date_from']:
-                        if int(resolution['date_from'].split('-')[0]) < 2000:
-                            resolution['date_from'] = "'2000-01-01'"
-                        else:
-                            resolution['date_from'] = "'" + resolution['date_from'] + "'"
-                    else:
-                        resolution['date_from'] = 'NULL'
-
-                    if resolution['date_to']:
-                        if int(resolution['date_to'].split('-')[0]) < 2000:
-                            resolution['date_to'] = "'2000-01-01'"
-                        else:
-                            resolution['date_to'] = "'" + resolution['date_to'] + "'"
-                    else:
-                        resolution['date_to'] = 'NULL'
-
-                    # Syncing Odoo with API
-                    resolution_search = self.env['l10n_co_edi_jorels.resolution'].search(
-                        [('resolution_id', '=', resolution['id'])])
-
-                    # TO DO: Update with UPDATE if it already exists
-                    # If it is not already in the database then add it
-                    if not resolution_search:
-                        self._cr.execute(
-                            "INSERT INTO l10n_co_edi_jorels_resolution (" \
-                            "resolution_api_sync," \
-                            "resolution_type_document_id," \
-                            "resolution_prefix," \
-                            "resolution_resolution," \
-                            "resolution_resolution_date," \
-                            "resolution_technical_key," \
-                            "resolution_from," \
-                            "resolution_to," \
-                            "resolution_date_from," \
-                            "resolution_date_to," \
-                            "resolution_id," \
-                            "resolution_number," \
-                            "resolution_next_consecutive," \
-                            "create_uid," \
-                            "create_date," \
-                            "write_uid," \
-                            "write_date" \
-                            ") VALUES (TRUE, %d, '%s', NULLIF('%s','None'), %s, NULLIF('%s','None'), %d, %d, %s, %s, %d, %d, '%s', %d, %s, %d, %s)" %
-                            (
-                                resolution['type_document_id'],
-                                resolution['prefix'],
-                                resolution['resolution'],
-                                resolution['resolution_date'],
-                                resolution['technical_key'],
-                                resolution['from'],
-                                resolution['to'],
-                                resolution['date_from'],
-                                resolution['date_to'],
-                                resolution['id'],
-                                resolution['number'],
-                                resolution['next_consecutive'],
-                                self.env.user.id,
-                                'NOW()',
-                                self.env.user.id,
-                                'NOW()'
-                            )
-                        )
+            resolution_env = self.env['l10n_co_edi_jorels.resolution']
+            company = self.env.user.company_id
+            resolution_env.sync_resolutions(company, resolution_env._get_remote_resolutions(company), force=True)
         except Exception as e:
             raise Warning(e)
 
@@ -186,17 +104,8 @@ class ResConfigSettings(models.TransientModel):
                 _logger.debug("Request environment DIAN: %s", json.dumps(requests_data, indent=2, sort_keys=False))
 
                 token = rec.api_key
-                api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                           'https://edipo.jorels.com')
                 params = {'token': token}
-                header = {"accept": "application/json", "Content-Type": "application/json"}
-                api_url = api_url + "/environment"
-
-                response = requests.put(api_url,
-                                        json.dumps(requests_data),
-                                        headers=header,
-                                        params=params).json()
-                _logger.debug('API Response PUT environment: %s', response)
+                response = self.env['l10n_co_edi_jorels.edipo'].request('PUT', "/environment", requests_data, params)
 
                 if 'detail' in response:
                     raise Warning(response['detail'])
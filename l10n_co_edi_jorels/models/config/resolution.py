@@ -20,15 +20,29 @@
 # email: info@jorels.com
 #
 
+import hashlib
 import json
 import logging
+from datetime import date
 
-import requests
 from odoo import api, fields, models, _
 from odoo.exceptions import Warning
 
 _logger = logging.getLogger(__name__)
 
+# Resolution fields sent to the API, and their keys in the API
+API_FIELDS = (
+    ('resolution_type_document_id', 'code'),
+    ('resolution_prefix', 'prefix'),
+    ('resolution_resolution', 'resolution'),
+    ('resolution_resolution_date', 'resolution_date'),
+    ('resolution_technical_key', 'technical_key'),
+    ('resolution_from', 'number_from'),
+    ('resolution_to', 'number_to'),
+    ('resolution_date_from', 'date_from'),
+    ('resolution_date_to', 'date_to'),
+)
+
 
 class Resolution(models.Model):
     _name = 'l10n_co_edi_jorels.resolution'
@@ -58,225 +72,379 @@ class Resolution(models.Model):
 
     resolution_message = fields.Char(string="Message", readonly=True)
 
+    # Synchronization with the API
+    active = fields.Boolean(string="Active", default=True)
+    company_id = fields.Many2one(comodel_name='res.company', string="Company", readonly=True, copy=False,
+                                 default=lambda self: self.env.user.company_id)
+    resolution_sync_hash = fields.Char(string="Sync hash", readonly=True, copy=False)
+
+    _sql_constraints = [
+        ('resolution_id_uniq', 'unique (resolution_id)', "There is already a resolution with this API ID."),
+    ]
+
     def _compute_name(self):
         for rec in self:
             rec.name = str(rec.resolution_id) + ' - ' + \
                        rec.resolution_type_document_id.name + ' [' + rec.resolution_type_document_id.code + ']'
 
     @api.model
-    def create(self, vals):
-        if vals['resolution_api_sync']:
-            vals, success = self.post_resolution(vals)
-            if success:
-                return super(Resolution, self).create(vals)
-            else:
-                raise Warning(_("Could not save record to API"))
-        else:
-            return super(Resolution, self).create(vals)
+    def _normalize_api_date(self, value):
+        if not value:
+            return None
+        if int(value.split('-')[0]) < 2000:
+            return '2000-01-01'
+        return value
 
-    @api.multi
-    def write(self, vals):
-        for rec in self:
-            if rec.resolution_api_sync:
-                vals, success = self.put_resolution(vals)
-                if success:
-                    return super(Resolution, self).write(vals)
-                else:
-                    raise Warning(_("Could not update record in API"))
+    @api.model
+    def _get_remote_resolutions(self, company):
+        """Resolutions of the company in the API"""
+        params = {'token': str(company.api_key)}
+        response = self.env['l10n_co_edi_jorels.edipo'].request('GET', "/resolutions", params=params,
+                                                                 idempotent=True)
+        if 'detail' in response:
+            raise Warning(response['detail'])
+        if 'message' in response:
+            if response['message'] == 'Unauthenticated.' or response['message'] == '':
+                raise Warning(_('Unable to authenticate with the API. Please check your API key and try again.'))
             else:
-                return super(Resolution, self).write(vals)
+                raise Warning(response['message'])
+        return response
 
-    @api.multi
-    def unlink(self):
-        for rec in self:
-            if rec.resolution_api_sync:
-                success = self.delete_resolution()
-                if success:
-                    return super(models.Model, self).unlink()
-                else:
-                    raise Warning(_("Could not delete record in API"))
-            else:
-                return super(models.Model, self).unlink()
+    @api.model
+    def sync_resolutions(self, company, remote_resolutions, force=False):
+        """Apply the resolutions of the API to the local ones, with set-based SQL
+
+        New resolutions are inserted, changed ones updated, and the synchronized resolutions of
+        the company which are not in the API anymore are archived.
+
+        :return: dict with the number of inserted, updated and archived resolutions, or None
+            when the resolutions didn't change since the last sync
+        """
+        columns = ('resolution_id', 'resolution_type_document_id', 'resolution_prefix', 'resolution_resolution',
+                   'resolution_resolution_date', 'resolution_technical_key', 'resolution_from', 'resolution_to',
+                   'resolution_date_from', 'resolution_date_to', 'resolution_number',
+                   'resolution_next_consecutive')
+        rows = sorted((
+            resolution['id'],
+            resolution['type_document_id'],
+            resolution['prefix'],
+            resolution['resolution'],
+            self._normalize_api_date(resolution['resolution_date']),
+            resolution['technical_key'],
+            resolution['from'],
+            resolution['to'],
+            self._normalize_api_date(resolution['date_from']),
+            self._normalize_api_date(resolution['date_to']),
+            resolution['number'],
+            str(resolution['next_consecutive']) if resolution['next_consecutive'] is not None else None,
+        ) for resolution in remote_resolutions)
+
+        # The whole list is the sync version, nothing is written when it didn't change
+        config_env = self.env['ir.config_parameter'].sudo()
+        version_key = 'jorels.edipo.resolutions_hash_%s' % company.id
+        version = hashlib.sha1(json.dumps(rows).encode('utf-8')).hexdigest()
+        if not force and config_env.get_param(version_key) == version:
+            _logger.debug("Resolutions of the company %s unchanged", company.id)
+            return None
+
+        hashes = [hashlib.sha1(json.dumps(row).encode('utf-8')).hexdigest() for row in rows]
+        values = list(zip(*rows)) if rows else [[] for column in columns]
+        self._cr.execute("DROP TABLE IF EXISTS resolution_staging")
+        self._cr.execute("""
+            CREATE TEMP TABLE resolution_staging AS
+            SELECT * FROM unnest(%s::int[], %s::int[], %s::varchar[], %s::varchar[], %s::date[], %s::varchar[],
+                                 %s::int[], %s::int[], %s::date[], %s::date[], %s::int[], %s::varchar[],
+                                 %s::varchar[])
+                AS r(resolution_id, resolution_type_document_id, resolution_prefix, resolution_resolution,
+                     resolution_resolution_date, resolution_technical_key, resolution_from, resolution_to,
+                     resolution_date_from, resolution_date_to, resolution_number, resolution_next_consecutive,
+                     resolution_sync_hash)
+        """, [list(column_values) for column_values in values] + [hashes])
+
+        column_list = ",".join(columns)
+        params = {'uid': self.env.uid, 'company_id': company.id}
+        self._cr.execute("""
+            INSERT INTO l10n_co_edi_jorels_resolution (%s, resolution_sync_hash, resolution_api_sync, active,
+                                                       company_id, create_uid, create_date, write_uid, write_date)
+            SELECT %s, s.resolution_sync_hash, TRUE, TRUE, %%(company_id)s, %%(uid)s, NOW(), %%(uid)s, NOW()
+            FROM resolution_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM l10n_co_edi_jorels_resolution r WHERE r.resolution_id = s.resolution_id)
+            ON CONFLICT DO NOTHING
+        """ % (column_list, ",".join("s." + column for column in columns)), params)
+        inserted = self._cr.rowcount
+
+        self._cr.execute("""
+            UPDATE l10n_co_edi_jorels_resolution r
+            SET %s, resolution_sync_hash = s.resolution_sync_hash, active = TRUE,
+                company_id = COALESCE(r.company_id, %%(company_id)s), write_uid = %%(uid)s, write_date = NOW()
+            FROM resolution_staging s
+            WHERE r.resolution_id = s.resolution_id
+              AND (r.resolution_sync_hash IS DISTINCT FROM s.resolution_sync_hash OR NOT r.active
+                   OR r.company_id IS NULL)
+        """ % ", ".join("%s = s.%s" % (column, column) for column in columns[1:]), params)
+        updated = self._cr.rowcount
+
+        # Removed in the API: archived, the sequences and invoices keep their resolution.
+        # Resolutions synchronized before they had a company are archived as well.
+        self._cr.execute("""
+            UPDATE l10n_co_edi_jorels_resolution r
+            SET active = FALSE, write_uid = %(uid)s, write_date = NOW()
+            WHERE COALESCE(r.company_id, %(company_id)s) = %(company_id)s AND r.resolution_api_sync AND r.active
+              AND r.resolution_id IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM resolution_staging s WHERE s.resolution_id = r.resolution_id)
+        """, params)
+        archived = self._cr.rowcount
+
+        self._cr.execute("DROP TABLE resolution_staging")
+        self.invalidate_cache()
+        config_env.set_param(version_key, version)
+
+        summary = {'inserted': inserted, 'updated': updated, 'archived': archived}
+        _logger.info("Resolutions of the company %s synchronized: %s", company.id, summary)
+        return summary
+
+    @api.model
+    def _cron_sync_resolutions(self):
+        companies = self.env['res.company'].search([('ei_enable', '=', True), ('api_key', '!=', False)])
+        for company in companies:
+            try:
+                self.sync_resolutions(company, self._get_remote_resolutions(company))
+                self._cr.commit()
+            except Exception as e:
+                self._cr.rollback()
+                _logger.warning("Resolutions of the company %s could not be synchronized: %s", company.id, e)
+        return True
 
-    # Resolution creation
     @api.multi
-    def post_resolution(self, vals):
-        success = False
+    def _get_api_values(self):
+        self.ensure_one()
+        return {
+            'resolution_type_document_id': self.resolution_type_document_id.id,
+            'resolution_prefix': self.resolution_prefix,
+            'resolution_resolution': self.resolution_resolution,
+            'resolution_resolution_date': self.resolution_resolution_date,
+            'resolution_technical_key': self.resolution_technical_key,
+            'resolution_from': self.resolution_from,
+            'resolution_to': self.resolution_to,
+            'resolution_date_from': self.resolution_date_from,
+            'resolution_date_to': self.resolution_date_to,
+        }
+
+    @api.model
+    def _get_request_data(self, values, update=False):
+        """Request data of the API for the resolution values
+
+        :param update: the empty values are sent too, to clear them in the API
+        """
+        requests_data = {}
+        for field_name, key in API_FIELDS:
+            value = values.get(field_name)
+            if isinstance(value, date):
+                value = fields.Date.to_string(value)
+            if value or key in ('code', 'number_from', 'number_to'):
+                requests_data[key] = value
+            elif update:
+                requests_data[key] = ''
+        return requests_data
+
+    @api.model
+    def _get_api_params(self):
+        # The function str() is necessary for 'False' answers and boolean exceptions
+        return {'token': str(self.env.user.company_id.api_key)}
+
+    @api.model
+    def _parse_api_response(self, response):
+        """Result of a resolution API response
+
+        :return: (success, resolution returned by the API, message)
+        """
+        if isinstance(response, Exception):
+            _logger.debug("Connection error: %s", response)
+            return False, None, _("API connection error!")
+        if 'detail' in response:
+            return False, None, response['detail']
+
+        message = response.get('message')
+        if message == 'Unauthenticated.':
+            message = _('Unable to authenticate with the API. Please check your API key and try again.')
+        if 'resolution' in response:
+            return True, response['resolution'], message or False
+        if message == 'Resolución eliminada con éxito':
+            return True, None, message
+        return False, None, message or _('Unable to communicate with the API')
+
+    @api.model
+    def _format_api_errors(self, title, errors):
+        return title + "\n" + "\n".join("%s: %s" % (label, message) for label, message in errors)
+
+    @api.model
+    def _delete_remote(self, resolution_ids):
+        """Delete resolutions in the API, used to undo a failed multi-record operation"""
+        calls = [(resolution_id, 'DELETE', "/resolution/" + str(resolution_id), None, self._get_api_params())
+                 for resolution_id in resolution_ids]
+        for resolution_id, response in self.env['l10n_co_edi_jorels.edipo'].request_many(calls).items():
+            success, resolution, message = self._parse_api_response(response)
+            if not success:
+                _logger.error("Resolution %s could not be deleted again in the API: %s", resolution_id, message)
+
+    @api.model
+    def _restore_remote(self, requests_data):
+        """Create again in the API the resolutions deleted by a failed unlink
+
+        :param requests_data: dict record id -> request data of the deleted resolution
+        """
+        calls = [(record_id, 'POST', "/resolution", data, self._get_api_params())
+                 for record_id, data in requests_data.items()]
+        responses = self.env['l10n_co_edi_jorels.edipo'].request_many(calls)
+        # The unlink is rolled back, so the new API ids are saved in their own transaction.
+        # It doesn't wait for rows still locked by the failed transaction.
+        with self.pool.cursor() as cr:
+            cr.execute("SET LOCAL lock_timeout = '5s'")
+            for record_id, response in responses.items():
+                success, resolution, message = self._parse_api_response(response)
+                if not success:
+                    _logger.error("Resolution %s was deleted in the API and could not be restored: %s",
+                                  record_id, message)
+                    continue
+                try:
+                    with cr.savepoint():
+                        cr.execute("""
+                            UPDATE l10n_co_edi_jorels_resolution
+                            SET resolution_id = %s, resolution_number = %s, resolution_next_consecutive = %s
+                            WHERE id = %s
+                        """, (resolution['id'], resolution['number'], resolution['next_consecutive'], record_id))
+                        updated = cr.rowcount
+                except Exception as e:
+                    _logger.debug("Resolution %s could not be updated: %s", record_id, e)
+                    updated = 0
+                if not updated:
+                    _logger.error("Resolution %s was created again in the API with the id %s, but it could not "
+                                  "be saved", record_id, resolution['id'])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        if self._context.get('resolution_no_api'):
+            return super(Resolution, self).create(vals_list)
+
+        params = self._get_api_params()
+        calls = [(i, 'POST', "/resolution", self._get_request_data(vals), params)
+                 for i, vals in enumerate(vals_list) if vals.get('resolution_api_sync', True)]
+        _logger.debug("Request create resolutions DIAN: %s", calls)
+
+        created = []
         try:
-            requests_data = {
-                'code': vals['resolution_type_document_id']
-            }
-
-            if vals['resolution_prefix']:
-                requests_data['prefix'] = vals['resolution_prefix']
-
-            if vals['resolution_resolution']:
-                requests_data['resolution'] = vals['resolution_resolution']
-
-            if vals['resolution_resolution_date']:
-                requests_data['resolution_date'] = vals['resolution_resolution_date']
-
-            if vals['resolution_technical_key']:
-                requests_data['technical_key'] = vals['resolution_technical_key']
-
-            requests_data['number_from'] = vals['resolution_from']
-            requests_data['number_to'] = vals['resolution_to']
-
-            if vals['resolution_date_from']:
-                requests_data['date_from'] = vals['resolution_date_from']
-
-            if vals['resolution_date_to']:
-                requests_data['date_to'] = vals['resolution_date_to']
-
-            _logger.debug("Request create resolution DIAN: %s",
-                          json.dumps(requests_data, indent=2, sort_keys=False))
-
-            token = str(self.env.user.company_id.api_key)
-            api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                       'https://edipo.jorels.com')
-            params = {'token': token}
-            header = {"accept": "application/json", "Content-Type": "application/json"}
-            api_url = api_url + "/resolution"
-            response = requests.post(api_url,
-                                     json.dumps(requests_data),
-                                     headers=header,
-                                     params=params).json()
-            _logger.debug('API Response: %s', response)
-
-            if 'resolution' in response:
-                vals['resolution_id'] = response['resolution']['id']
-                vals['resolution_number'] = response['resolution']['number']
-                vals['resolution_next_consecutive'] = response['resolution']['next_consecutive']
-                success = True
-
-            if 'detail' in response:
-                raise Warning(response['detail'])
-            if 'message' in response:
-                if response['message'] == 'Unauthenticated.':
-                    vals['resolution_message'] = _('Unable to authenticate with the API. '
-                                                   'Please check your API key and try again.')
-                else:
-                    vals['resolution_message'] = response['message']
-            else:
-                vals['resolution_message'] = _('Unable to communicate with the API')
-        except Exception as e:
-            vals['resolution_message'] = _("API connection error!")
-            _logger.debug("Connection error: %s", e)
-        return vals, success
+            # The local records are created first, a local error then stops before the API is called
+            with self._cr.savepoint():
+                records = super(Resolution, self).create(vals_list)
+
+                results = {}
+                errors = []
+                for i, response in sorted(self.env['l10n_co_edi_jorels.edipo'].request_many(calls).items()):
+                    success, resolution, message = self._parse_api_response(response)
+                    if success:
+                        created.append(resolution['id'])
+                        results[i] = (resolution, message)
+                    else:
+                        errors.append((vals_list[i].get('resolution_prefix') or i + 1, message))
+                if errors:
+                    raise Warning(self._format_api_errors(_("Could not save record to API"), errors))
+
+                for i, (resolution, message) in results.items():
+                    super(Resolution, records[i]).write({
+                        'resolution_id': resolution['id'],
+                        'resolution_number': resolution['number'],
+                        'resolution_next_consecutive': resolution['next_consecutive'],
+                        'resolution_message': message,
+                    })
+        except Exception:
+            # All or nothing: the resolutions already created in the API are deleted
+            self._delete_remote(created)
+            raise
+        return records
 
-    # Resolution update
     @api.multi
-    def put_resolution(self, vals):
-        success = False
-        for rec in self:
-            try:
-                # Resolution api id for update
-                resolution_id = str(rec.resolution_id)
-
-                requests_data = {
-                    'code': rec.resolution_type_document_id.id,
-                    'prefix': rec.resolution_prefix,
-                    'resolution': rec.resolution_resolution,
-                    'resolution_date': fields.Date.to_string(rec.resolution_resolution_date),
-                    'technical_key': rec.resolution_technical_key,
-                    'number_from': rec.resolution_from,
-                    'number_to': rec.resolution_to,
-                    'date_from': fields.Date.to_string(rec.resolution_date_from),
-                    'date_to': fields.Date.to_string(rec.resolution_date_to)
-                }
-
-                len_prefix = len('resolution_')
-                for val in vals:
-                    requests_data[val[len_prefix:]] = vals[val]
-
-                if not requests_data['prefix']:
-                    requests_data['prefix'] = ''
-
-                if not requests_data['resolution']:
-                    requests_data['resolution'] = ''
-
-                if not requests_data['resolution_date']:
-                    requests_data['resolution_date'] = ''
-
-                if not requests_data['technical_key']:
-                    requests_data['technical_key'] = ''
-
-                if not requests_data['date_from']:
-                    requests_data['date_from'] = ''
-
-                if not requests_data['date_to']:
-                    requests_data['date_to'] = ''
-
-                _logger.debug("Request update resolution DIAN: %s",
-                              json.dumps(requests_data, indent=2, sort_keys=False))
-
-                token = str(self.env.user.company_id.api_key)
-                api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                           'https://edipo.jorels.com')
-                params = {'token': token}
-                header = {"accept": "application/json", "Content-Type": "application/json"}
-                api_url = api_url + "/resolution/" + resolution_id
-                response = requests.put(api_url,
-                                        json.dumps(requests_data),
-                                        headers=header,
-                                        params=params).json()
-                _logger.debug('API Response: %s', response)
-
-                if 'resolution' in response:
-                    vals['resolution_number'] = response['resolution']['number']
-                    vals['resolution_next_consecutive'] = response['resolution']['next_consecutive']
-                    success = True
-
-                if 'detail' in response:
-                    raise Warning(response['detail'])
-                if 'message' in response:
-                    if response['message'] == 'Unauthenticated.':
-                        vals['resolution_message'] = _('Unable to authenticate with the API. '
-                                                       'Please check your API key and try again.')
+    def write(self, vals):
+        api_vals = {field_name: vals[field_name] for field_name, key in API_FIELDS if field_name in vals}
+        to_sync = self.browse()
+        if api_vals and not self._context.get('resolution_no_api'):
+            to_sync = self.filtered(lambda rec: rec.resolution_api_sync)
+        if not to_sync:
+            return super(Resolution, self).write(vals)
+
+        params = self._get_api_params()
+        undo_calls = {}
+        calls = []
+        for rec in to_sync:
+            values = rec._get_api_values()
+            path = "/resolution/" + str(rec.resolution_id)
+            undo_calls[rec.id] = (rec.id, 'PUT', path, self._get_request_data(values, update=True), params)
+            values.update(api_vals)
+            calls.append((rec.id, 'PUT', path, self._get_request_data(values, update=True), params))
+        _logger.debug("Request update resolutions DIAN: %s", calls)
+
+        results = {}
+        try:
+            # The local records are written first, a local error then stops before the API is called
+            with self._cr.savepoint():
+                res = super(Resolution, self).write(vals)
+
+                errors = []
+                for record_id, response in self.env['l10n_co_edi_jorels.edipo'].request_many(calls).items():
+                    success, resolution, message = self._parse_api_response(response)
+                    if success:
+                        results[record_id] = (resolution, message)
                     else:
-                        vals['resolution_message'] = response['message']
-                else:
-                    vals['resolution_message'] = _('Unable to communicate with the API')
-            except Exception as e:
-                vals['resolution_message'] = _("API connection error!")
-                _logger.debug("Connection error: %s", e)
-        return vals, success
+                        errors.append((self.browse(record_id).name, message))
+                if errors:
+                    raise Warning(self._format_api_errors(_("Could not update record in API"), errors))
+
+                for rec in to_sync:
+                    resolution, message = results[rec.id]
+                    super(Resolution, rec).write({
+                        'resolution_number': resolution['number'],
+                        'resolution_next_consecutive': resolution['next_consecutive'],
+                        'resolution_message': message,
+                    })
+        except Exception:
+            # All or nothing: the resolutions already updated in the API get their previous values back
+            responses = self.env['l10n_co_edi_jorels.edipo'].request_many(
+                [undo_calls[record_id] for record_id in results])
+            for record_id, response in responses.items():
+                if not self._parse_api_response(response)[0]:
+                    _logger.error("Resolution %s could not be restored in the API", record_id)
+            raise
+        return res
 
-    # Resolution removal
     @api.multi
-    def delete_resolution(self):
-        success = False
-        for rec in self:
-            try:
-                # Resolution api id for update
-                resolution_id = str(rec.resolution_id)
-
-                # The function str() is necessary for 'False' answers and boolean exceptions
-                token = str(self.env.user.company_id.api_key)
-                api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                           'https://edipo.jorels.com')
-                params = {'token': token}
-                header = {"accept": "application/json", "Content-Type": "application/json"}
-                api_url = api_url + "/resolution/" + str(resolution_id)
-                response = requests.delete(api_url,
-                                           headers=header,
-                                           params=params).json()
-                _logger.debug('API Response: %s', response)
-
-                if 'detail' in response:
-                    raise Warning(response['detail'])
-                if 'message' in response:
-                    if response['message'] == 'Unauthenticated.':
-                        rec.resolution_message = _('Unable to authenticate with the API. '
-                                                   'Please check your API key and try again.')
-                    elif response['message'] == 'Resolución eliminada con éxito':
-                        success = True
+    def unlink(self):
+        to_sync = self.browse()
+        if not self._context.get('resolution_no_api'):
+            to_sync = self.filtered(lambda rec: rec.resolution_api_sync)
+
+        params = self._get_api_params()
+        names = {rec.id: rec.name for rec in to_sync}
+        previous_data = {rec.id: self._get_request_data(rec._get_api_values()) for rec in to_sync}
+        calls = [(rec.id, 'DELETE', "/resolution/" + str(rec.resolution_id), None, params) for rec in to_sync]
+
+        deleted = []
+        try:
+            # The local records are deleted first, e.g. a sequence that still uses one stops before the API is
+            # called. On failure the savepoint is rolled back, so the rows are free for _restore_remote.
+            with self._cr.savepoint():
+                res = super(Resolution, self).unlink()
+
+                errors = []
+                for record_id, response in self.env['l10n_co_edi_jorels.edipo'].request_many(calls).items():
+                    success, resolution, message = self._parse_api_response(response)
+                    if success:
+                        deleted.append(record_id)
                     else:
-                        rec.resolution_message = response['message']
-                else:
-                    rec.resolution_message = _('Unable to communicate with the API')
-            except Exception as e:
-                rec.resolution_message = _('API connection error!')
-                _logger.debug("Connection error: %s", e)
-                raise Warning(rec.resolution_message)
-        return success
+                        errors.append((names[record_id], message))
+                if errors:
+                    raise Warning(self._format_api_errors(_("Could not delete record in API"), errors))
+        except Exception:
+            # All or nothing: the resolutions already deleted in the API are created again
+            if deleted:
+                self._restore_remote({record_id: previous_data[record_id] for record_id in deleted})
+            raise
+        return res
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from odoo import api, models, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = 'https://edipo.jorels.com'
+
+# One session per process: keep-alive connections are reused by all the requests of the worker
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=10):
+    global _session, _session_pid
+    with _session_lock:
+        # Prefork workers must not share the sockets of the parent process
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({"accept": "application/json", "Content-Type": "application/json"})
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+class ApiUnavailable(requests.RequestException):
+    """The circuit breaker is open: the request was not sent"""
+
+
+class CircuitBreaker(object):
+    """Consecutive failures of the API in this process.
+
+    After failure_threshold consecutive failures the circuit opens and the requests fail fast. Once
+    reset_timeout seconds have elapsed, a single request is let through to probe the API (half-open):
+    the circuit closes if it succeeds and opens again if it fails.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self, reset_timeout):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if not self.probing and time.monotonic() - self.opened_at >= reset_timeout:
+                return 'half_open'
+            return 'open'
+
+    def allow(self, reset_timeout):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= reset_timeout:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                _logger.info("The edipo API is available again")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self, failure_threshold):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= failure_threshold:
+                if self.opened_at is None:
+                    _logger.warning("The edipo API failed %s consecutive times, requests are suspended",
+                                    self.failures)
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+breaker = CircuitBreaker()
+
+
+def _send_once(method, url, data, params, timeout, deadline, pool_size, failure_threshold, reset_timeout):
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout("The deadline for the API request has expired")
+        timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+
+    if not breaker.allow(reset_timeout):
+        raise ApiUnavailable(_("The API is temporarily unavailable, try again later"))
+
+    body = json.dumps(data) if data is not None else None
+    try:
+        response = get_session(pool_size).request(method, url, data=body, params=params, timeout=timeout)
+        result = response.json()
+    except (requests.RequestException, ValueError):
+        breaker.record_failure(failure_threshold)
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure(failure_threshold)
+    else:
+        breaker.record_success()
+    return result
+
+
+def send(method, url, data=None, params=None, timeout=(10, 60), deadline=None, pool_size=10,
+         failure_threshold=5, reset_timeout=60, retries=0, retry_delay=0.5):
+    """Send a request to the API and return the decoded json response.
+
+    It does not use the environment, so it can be called from threads.
+    :param timeout: (connect, read) timeouts in seconds
+    :param deadline: time.monotonic() value after which the request must not wait any longer
+    :param retries: number of times the request is repeated after a network error, only for idempotent requests
+    """
+    attempt = 0
+    while True:
+        try:
+            return _send_once(method, url, data, params, timeout, deadline, pool_size, failure_threshold,
+                              reset_timeout)
+        except ApiUnavailable:
+            raise
+        except (requests.RequestException, ValueError) as e:
+            if attempt >= retries:
+                raise
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, retry_delay * 2 ** attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            _logger.debug("API request failed, retrying in %.2f s: %s", delay, e)
+            time.sleep(delay)
+            attempt += 1
+
+
+def send_with_options(options, method, url, data, params, idempotent=False):
+    """Send a request with the options of Edipo.get_request_options()"""
+    return send(method, url, data=data, params=params, timeout=options['timeout'],
+                deadline=time.monotonic() + options['deadline'], pool_size=options['pool_size'],
+                failure_threshold=options['failure_threshold'], reset_timeout=options['reset_timeout'],
+                retries=options['retries'] if idempotent else 0, retry_delay=options['retry_delay'])
+
+
+def error_message(response):
+    """Return the error message of an API response, or None if it is not an error"""
+    if not isinstance(response, dict):
+        return None
+    if 'detail' in response:
+        return str(response['detail'])
+    if 'message' in response:
+        if response['message'] == 'Unauthenticated.' or response['message'] == '':
+            return _("Authentication error with the API")
+        elif 'errors' in response:
+            return response['message'] + '/ errors: ' + str(response['errors'])
+        else:
+            return response['message']
+    return None
+
+
+class Edipo(models.AbstractModel):
+    _name = "l10n_co_edi_jorels.edipo"
+    _description = "Edipo API client"
+
+    @api.model
+    def get_api_url(self):
+        return self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url', DEFAULT_API_URL)
+
+    @api.model
+    def get_request_options(self):
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return {
+            'timeout': (float(get_param('jorels.edipo.connect_timeout', 10)),
+                        float(get_param('jorels.edipo.read_timeout', 60))),
+            'deadline': float(get_param('jorels.edipo.deadline', 120)),
+            'pool_size': int(get_param('jorels.edipo.pool_size', 10)),
+            'max_workers': int(get_param('jorels.edipo.max_workers', 8)),
+            'failure_threshold': int(get_param('jorels.edipo.failure_threshold', 5)),
+            'reset_timeout': float(get_param('jorels.edipo.reset_timeout', 60)),
+            'retries': int(get_param('jorels.edipo.retries', 2)),
+            'retry_delay': float(get_param('jorels.edipo.retry_delay', 0.5)),
+        }
+
+    @api.model
+    def is_api_available(self):
+        """False while the circuit breaker is open, before the next probe is due"""
+        return breaker.state(self.get_request_options()['reset_timeout']) != 'open'
+
+    @api.model
+    def request(self, method, path, data=None, params=None, idempotent=False):
+        """Send a request to the API.
+
+        :param idempotent: the request only reads data, so it is retried after a network error
+        """
+        url = self.get_api_url() + path
+        options = self.get_request_options()
+        _logger.debug('API URL: %s', url)
+        response = send_with_options(options, method, url, data, params, idempotent)
+        _logger.debug('API Response: %s', response)
+        return response
+
+    @api.model
+    def request_many(self, calls, max_workers=None, idempotent=False):
+        """Send several requests concurrently with a bounded thread pool.
+
+        :param calls: list of (key, method, path, data, params)
+        :return: dict key -> response, or the exception raised by its request
+        """
+        if not calls:
+            return {}
+
+        url = self.get_api_url()
+        options = self.get_request_options()
+        max_workers = min(max_workers or options['max_workers'], len(calls))
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            futures = {
+                executor.submit(send_with_options, options, method, url + path, data, params, idempotent): key
+                for key, method, path, data, params in calls
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    _logger.debug("API request %s failed: %s", key, e)
+                    results[key] = e
+        return results
+
+    @api.model
+    def check_response(self, response):
+        """Raise the error message of the response, if any"""
+        message = error_message(response)
+        if message is not None:
+            raise UserError(message)
+        return response
+
+    @api.model
+    def _get_status_poll_models(self):
+        """Models whose pending documents are polled by the status scheduler"""
+        return ['account.invoice', 'l10n_co_edi_jorels.radian']
+
+    @api.model
+    def _cron_poll_status(self):
+        batch = int(self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.poll_batch', 100))
+        for model_name in self._get_status_poll_models():
+            while True:
+                polled = self.env[model_name]._poll_status(batch)
+                # Keep the responses already received if a later batch fails
+                self._cr.commit()
+                if polled < batch:
+                    break
+        return True
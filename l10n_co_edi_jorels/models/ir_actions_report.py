@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import base64
+import hashlib
+import io
+import logging
+
+from odoo import api, models
+
+_logger = logging.getLogger(__name__)
+
+EI_INVOICE_REPORTS = ('account.report_invoice', 'account.report_invoice_with_payments')
+
+
+class IrActionsReport(models.Model):
+    _inherit = 'ir.actions.report'
+
+    @api.multi
+    def _get_ei_pdf_layout(self):
+        """Last change of the report or of any QWeb template, the layouts included"""
+        self.ensure_one()
+        self._cr.execute("SELECT max(write_date) FROM ir_ui_view WHERE type = 'qweb'")
+        return str((self.write_date, self._cr.fetchone()[0]))
+
+    @api.multi
+    def _get_ei_pdf_version(self, invoice):
+        """Key of everything the printed electronic invoice depends on"""
+        company = invoice.company_id
+        paperformat = self.paperformat_id or company.paperformat_id
+        values = (self.report_name, invoice.ei_uuid, invoice.state, invoice.residual,
+                  self.env.context.get('lang') or invoice.partner_id.lang,
+                  self._context.get('ei_pdf_layout') or self._get_ei_pdf_layout(),
+                  company.write_date, company.partner_id.write_date, paperformat.write_date)
+        return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+    @api.multi
+    def _get_ei_pdf_name(self, invoice):
+        return 'ei_pdf_' + self._get_ei_pdf_version(invoice) + '.pdf'
+
+    @api.multi
+    def _get_ei_cached_pdfs(self, invoices):
+        """PDFs already printed for the current version of the invoices: invoice id -> PDF"""
+        invoices = invoices.with_context(bin_size=False)
+        pdfs = {}
+        for invoice in invoices:
+            if invoice.company_id.ei_pdf_source == 'dian' and invoice.ei_pdf_base64_bytes:
+                pdfs[invoice.id] = base64.b64decode(invoice.ei_pdf_base64_bytes)
+
+        # Stored in a field, so the files don't show in the chatter of the invoice
+        names = {self._get_ei_pdf_name(invoice): invoice.id for invoice in invoices if invoice.id not in pdfs}
+        attachments = self.env['ir.attachment'].sudo().with_context(bin_size=False).search([
+            ('res_model', '=', 'account.invoice'),
+            ('res_field', '=', 'ei_pdf_cache'),
+            ('res_id', 'in', list(names.values())),
+            ('name', 'in', list(names)),
+        ])
+        for attachment in attachments:
+            if attachment.datas and attachment.res_id == names[attachment.name]:
+                pdfs[attachment.res_id] = base64.b64decode(attachment.datas)
+        return pdfs
+
+    @api.multi
+    def _store_ei_pdf(self, invoice, pdf):
+        """Keep the PDF of the current version of the invoice, in place of the previous one"""
+        attachment_env = self.env['ir.attachment'].sudo()
+        name = self._get_ei_pdf_name(invoice)
+        attachment_env.search([
+            ('res_model', '=', 'account.invoice'),
+            ('res_field', '=', 'ei_pdf_cache'),
+            ('res_id', '=', invoice.id),
+        ]).unlink()
+        attachment_env.create({
+            'name': name,
+            'datas_fname': name,
+            'res_model': 'account.invoice',
+            'res_field': 'ei_pdf_cache',
+            'res_id': invoice.id,
+            'type': 'binary',
+            'datas': base64.b64encode(pdf),
+            'mimetype': 'application/pdf',
+        })
+        _logger.debug("Electronic invoice PDF %s cached", name)
+
+    @api.multi
+    def retrieve_attachment(self, record):
+        # The invoices without a cached PDF are rendered again, even if the report kept a copy of them
+        if self._context.get('ei_pdf_rendered') is not None:
+            return None
+        return super(IrActionsReport, self).retrieve_attachment(record)
+
+    @api.multi
+    def postprocess_pdf_report(self, record, buffer):
+        # The report splits the batch by invoice with its attachment expression, each part is cached
+        rendered = self._context.get('ei_pdf_rendered')
+        if rendered is not None:
+            rendered[record.id] = buffer.getvalue()
+            self._store_ei_pdf(record, rendered[record.id])
+            return buffer
+        return super(IrActionsReport, self).postprocess_pdf_report(record, buffer)
+
+    @api.multi
+    def render_qweb_pdf(self, res_ids=None, data=None):
+        if len(self) != 1 or self.model != 'account.invoice' or self.report_name not in EI_INVOICE_REPORTS \
+                or not res_ids or self.env.context.get('ei_no_pdf_cache'):
+            return super(IrActionsReport, self).render_qweb_pdf(res_ids, data)
+
+        # Only valid electronic invoices are frozen enough to be served from a stored PDF
+        invoices = self.env['account.invoice'].browse(res_ids)
+        if not all(inv.company_id.ei_enable and inv.ei_is_valid and inv.ei_uuid for inv in invoices):
+            return super(IrActionsReport, self).render_qweb_pdf(res_ids, data)
+
+        # The layout is read once for the whole batch
+        self = self.with_context(ei_pdf_layout=self._get_ei_pdf_layout())
+        pdfs = self._get_ei_cached_pdfs(invoices)
+        missing = invoices.filtered(lambda inv: inv.id not in pdfs)
+        if missing:
+            rendered = {}
+            report = self.with_context(ei_no_pdf_cache=True, ei_pdf_rendered=rendered)
+            # The missing PDFs are rendered at once, the report splits them with its attachment expression
+            if self.attachment or len(missing) == 1:
+                pdf = report.render_qweb_pdf(missing.ids, data)[0]
+                if len(missing) == 1 and not rendered:
+                    self._store_ei_pdf(missing, pdf)
+                    rendered[missing.id] = pdf
+            pdfs.update(rendered)
+
+            # Without an attachment expression the report can't split the batch, those are rendered one by one
+            for invoice in missing.filtered(lambda inv: inv.id not in pdfs):
+                pdfs[invoice.id] = report.render_qweb_pdf([invoice.id], data)[0]
+                self._store_ei_pdf(invoice, pdfs[invoice.id])
+
+        if len(invoices) == 1:
+            return pdfs[invoices.id], 'pdf'
+        return self._merge_pdfs([io.BytesIO(pdfs[invoice.id]) for invoice in invoices]), 'pdf'
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import json
+import logging
+import time
+
+from psycopg2.extensions import TransactionRollbackError
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from .payload import compress_payload, decompress_payload
+
+_logger = logging.getLogger(__name__)
+
+
+class Ledger(models.Model):
+    _name = "l10n_co_edi_jorels.ledger"
+    _description = "DIAN submission ledger"
+    _order = "id desc"
+    _rec_name = "number"
+
+    company_id = fields.Many2one(comodel_name='res.company', string="Company", required=True, readonly=True,
+                                 ondelete='cascade')
+    document_type = fields.Char(string="Document type", required=True, readonly=True)
+    number = fields.Char(string="Number", required=True, readonly=True)
+    is_test = fields.Boolean(string="Test", default=False, readonly=True)
+    attempts = fields.Integer(string="Attempts", default=0, readonly=True)
+    is_valid = fields.Boolean(string="Valid", default=False, readonly=True)
+    # The responses carry the signed documents in base64, they are kept compressed out of the table
+    response_data = fields.Binary(string="Response", attachment=True, readonly=True)
+    date_sent = fields.Datetime(string="Last sent on", readonly=True)
+
+    _sql_constraints = [
+        ('document_uniq', 'unique (company_id, document_type, number, is_test)',
+         "There is already a ledger entry for this document."),
+    ]
+
+    @api.model
+    def _claim(self, company, document_type, number, is_test=False):
+        """Lock the ledger entry of the document for this transaction.
+
+        Return an empty recordset if another transaction, in any worker, is already sending the document.
+        """
+        # Documents without their final number would share one entry, and its response
+        if not number or number in ('New', _('New')):
+            raise UserError(_("The document must have a number before it is sent to DIAN."))
+        key = "edipo:%s:%s:%s:%s" % (company.id, document_type, number, is_test)
+        self._cr.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (key,))
+        if not self._cr.fetchone()[0]:
+            return self.browse()
+
+        self._cr.execute("""
+            INSERT INTO l10n_co_edi_jorels_ledger
+                (company_id, document_type, number, is_test, attempts, is_valid,
+                 create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s, 0, false, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT (company_id, document_type, number, is_test) DO NOTHING
+        """, (company.id, document_type, number, is_test, self._uid, self._uid))
+        self._cr.execute("""
+            SELECT id FROM l10n_co_edi_jorels_ledger
+            WHERE company_id = %s AND document_type = %s AND number = %s AND is_test = %s
+            FOR UPDATE
+        """, (company.id, document_type, number, is_test))
+        return self.browse(self._cr.fetchone()[0])
+
+    @api.multi
+    def get_valid_response(self):
+        """The response of a previous valid submission, if any"""
+        self.ensure_one()
+        if self.is_valid:
+            data = self.with_context(bin_size=False).response_data
+            if data:
+                return json.loads(decompress_payload(data, indent=None))
+        return None
+
+    @api.multi
+    def save_response(self, response):
+        self.ensure_one()
+        self.write({
+            'attempts': self.attempts + 1,
+            'is_valid': bool(isinstance(response, dict) and response.get('is_valid')),
+            'response_data': compress_payload(json.dumps(response)),
+            'date_sent': fields.Datetime.now(),
+        })
+
+    @api.model
+    def send_once(self, company, document_type, number, send, is_test=False):
+        """Send a document with `send()`, at most once at a time.
+
+        The ledger entry is committed in its own transaction, so the response is kept even if the transaction of
+        the caller is rolled back. If another worker is sending the document, its answer is awaited, and if the
+        document was already validated, the stored response is returned instead of sending it again.
+        """
+        timeout = int(self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.ledger_wait', 30))
+        deadline = time.time() + timeout
+        while True:
+            with self.pool.cursor() as cr:
+                try:
+                    entry = self.with_env(self.env(cr=cr))._claim(company, document_type, number, is_test)
+                except TransactionRollbackError:
+                    # The entry was saved by a worker that finished after this snapshot, it is read again
+                    cr.rollback()
+                    entry = None
+
+                if entry:
+                    response = entry.get_valid_response()
+                    if response is not None:
+                        _logger.debug("The document %s was already valid, the previous response is used", number)
+                        return response
+
+                    response = send()
+                    entry.save_response(response)
+                    return response
+
+            if time.time() >= deadline:
+                raise UserError(_("The document %s is already being sent to DIAN. Check its status in a moment.")
+                                % number)
+            time.sleep(1)
@@ -21,17 +21,56 @@
 #
 
 import base64
-import tempfile
+import hashlib
 import zipfile
-from pathlib import Path
+from io import BytesIO
 
 from odoo import models, api
 from odoo.tools import pycompat
 
 
+def build_zip(files):
+    """Zip archive built in memory
+
+    :param files: list of (name, content bytes)
+    :return: zip bytes
+    """
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_archive:
+        for name, content in files:
+            zip_archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def files_checksum(files):
+    checksum = hashlib.sha1()
+    for name, content in files:
+        checksum.update(name.encode('utf-8'))
+        checksum.update(content)
+    return checksum.hexdigest()
+
+
 class MailTemplate(models.Model):
     _inherit = 'mail.template'
 
+    @api.model
+    def get_attached_zip(self, record, files, zip_field, checksum_field):
+        """Zip of the files, reusing the one stored on the record when its inputs are the same
+
+        :return: zip as base64
+        """
+        checksum = files_checksum(files)
+        record = record.with_context(bin_size=False)
+        if record[checksum_field] == checksum and record[zip_field]:
+            return record[zip_field]
+
+        attached_zip = base64.encodebytes(build_zip(files))
+        record.write({
+            zip_field: attached_zip,
+            checksum_field: checksum,
+        })
+        return attached_zip
+
     @api.multi
     def generate_email(self, res_ids, fields=None):
         res = super(MailTemplate, self).generate_email(res_ids, fields)
@@ -46,6 +85,8 @@ class MailTemplate(models.Model):
         if self._context.get('active_model') not in ('account.invoice', 'l10n_co_edi_jorels.radian'):
             return res
 
+        results = res if multi_mode else {res_ids[0]: res}
+
         if self._context.get('active_model') == 'account.invoice':
             for res_id, template in self.get_email_template(res_ids).items():
                 invoice = self.env['account.invoice'].browse(res_id)
@@ -53,47 +94,22 @@ class MailTemplate(models.Model):
                 if not invoice.company_id.ei_enable:
                     continue
 
-                attachments = res[res_id]['attachments'] if invoice.company_id.ei_include_pdf_attachment else []
+                attachments = results[res_id]['attachments'] if invoice.company_id.ei_include_pdf_attachment else []
 
                 if invoice.ei_is_valid \
                         and invoice.type in ('out_invoice', 'out_refund') \
                         and invoice.state not in ('draft', 'validate')\
-                        and invoice.ei_uuid:
-
-                    pdf_name = invoice.ei_uuid + '.pdf'
-                    pdf_path = Path(tempfile.gettempdir()) / pdf_name
-
-                    xml_name = invoice.ei_uuid + '.xml'
-                    xml_path = Path(tempfile.gettempdir()) / xml_name
-
-                    zip_name = invoice.ei_uuid + '.zip'
-                    zip_path = Path(tempfile.gettempdir()) / zip_name
-
-                    zip_archive = zipfile.ZipFile(zip_path, 'w')
-
-                    pdf_handle = open(pdf_path, 'wb')
-                    pdf_handle.write(base64.decodebytes(res[res_id]["attachments"][0][1]))
-                    pdf_handle.close()
-                    zip_archive.write(pdf_path, arcname=pdf_name)
-
-                    if invoice.ei_attached_document_base64_bytes:
-                        xml_handle = open(xml_path, 'wb')
-                        xml_handle.write(base64.decodebytes(invoice.ei_attached_document_base64_bytes))
-                        xml_handle.close()
-                        zip_archive.write(xml_path, arcname=xml_name)
-
-                    zip_archive.close()
-
-                    if invoice.ei_attached_document_base64_bytes:
-                        with open(zip_path, 'rb') as f:
-                            attached_zip = f.read()
-                            ei_attached_zip_base64_bytes = base64.encodebytes(attached_zip)
-                            attachments += [(zip_name, ei_attached_zip_base64_bytes)]
-                            invoice.write({
-                                'ei_attached_zip_base64_bytes': ei_attached_zip_base64_bytes
-                            })
-
-                res[res_id]["attachments"] = attachments
+                        and invoice.ei_uuid \
+                        and invoice.ei_attached_document_base64_bytes:
+                    files = [
+                        (invoice.ei_uuid + '.pdf', base64.decodebytes(results[res_id]["attachments"][0][1])),
+                        (invoice.ei_uuid + '.xml', base64.decodebytes(invoice.ei_attached_document_base64_bytes)),
+                    ]
+                    attached_zip = self.get_attached_zip(invoice, files, 'ei_attached_zip_base64_bytes',
+                                                         'ei_attached_zip_checksum')
+                    attachments += [(invoice.ei_uuid + '.zip', attached_zip)]
+
+                results[res_id]["attachments"] = attachments
 
         if self._context.get('active_model') == 'l10n_co_edi_jorels.radian':
             for res_id, template in self.get_email_template(res_ids).items():
@@ -102,55 +118,22 @@ class MailTemplate(models.Model):
                 if not radian.company_id.ei_enable:
                     continue
 
-                # attachments = res[res_id]["attachments"] if radian.company_id.ei_include_pdf_attachment else []
+                # attachments = results[res_id]["attachments"] if radian.company_id.ei_include_pdf_attachment else []
                 attachments = []
 
                 if radian.edi_is_valid \
                         and radian.state == 'posted'\
-                        and radian.edi_uuid:
-
-                    # pdf_name = radian.edi_uuid + '.pdf'
-                    # pdf_path = Path(tempfile.gettempdir()) / pdf_name
-
-                    xml_name = radian.edi_uuid + '.xml'
-                    xml_path = Path(tempfile.gettempdir()) / xml_name
-
-                    zip_name = radian.edi_uuid + '.zip'
-                    zip_path = Path(tempfile.gettempdir()) / zip_name
-
-                    zip_archive = zipfile.ZipFile(zip_path, 'w')
-
-                    # pdf_handle = open(pdf_path, 'wb')
-                    # pdf_handle.write(base64.decodebytes(res[res_id]["attachments"][0][1]))
-                    # pdf_handle.close()
-                    # zip_archive.write(pdf_path, arcname=pdf_name)
-
-                    if radian.edi_attached_document_base64:
-                        xml_handle = open(xml_path, 'wb')
-                        xml_handle.write(base64.decodebytes(radian.edi_attached_document_base64))
-                        xml_handle.close()
-                        zip_archive.write(xml_path, arcname=xml_name)
-
-                    zip_archive.close()
-
-                    if radian.edi_attached_document_base64:
-                        with open(zip_path, 'rb') as f:
-                            attached_zip = f.read()
-                            edi_attached_zip_base64 = base64.encodebytes(attached_zip)
-                            attachments += [(zip_name, edi_attached_zip_base64)]
-                            radian.write({
-                                'edi_attached_zip_base64': edi_attached_zip_base64
-                            })
-
-                if 'res_id' in res:
-                    if 'attachments' not in res:
-                        res['attachments'] = []
-                    res['attachments'] += attachments
-                else:
-                    if 'attachments' not in res[res_id]:
-                        res[res_id]['attachments'] = []
-                    res[res_id]['attachments'] += attachments
-
-            return res
-
-        return multi_mode and res or res[res_ids[0]]
+                        and radian.edi_uuid \
+                        and radian.edi_attached_document_base64:
+                    files = [
+                        (radian.edi_uuid + '.xml', base64.decodebytes(radian.edi_attached_document_base64)),
+                    ]
+                    attached_zip = self.get_attached_zip(radian, files, 'edi_attached_zip_base64',
+                                                         'edi_attached_zip_checksum')
+                    attachments += [(radian.edi_uuid + '.zip', attached_zip)]
+
+                if 'attachments' not in results[res_id]:
+                    results[res_id]['attachments'] = []
+                results[res_id]['attachments'] += attachments
+
+        return res
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import base64
+import json
+import logging
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+
+def compress_payload(payload):
+    """Compact and compress a JSON payload, for a binary field
+
+    :param payload: JSON text, any indentation
+    :return: base64 encoded zlib data, or False
+    """
+    if not payload:
+        return False
+    try:
+        payload = json.dumps(json.loads(payload), ensure_ascii=False, separators=(',', ':'))
+    except ValueError:
+        # Old payloads can be a python literal, they are kept as is
+        pass
+    return base64.b64encode(zlib.compress(payload.encode('utf-8'), 9))
+
+
+def decompress_payload(data, indent=2):
+    """Pretty printed payload from the data of compress_payload"""
+    if not data:
+        return False
+    payload = zlib.decompress(base64.b64decode(data)).decode('utf-8')
+    try:
+        return json.dumps(json.loads(payload), indent=indent, sort_keys=False)
+    except ValueError:
+        return payload
+
+
+def _table_size(cr, table):
+    cr.execute("SELECT pg_total_relation_size(%s)", (table,))
+    return cr.fetchone()[0]
+
+
+def migrate_payloads(env, model_name, column, data_field, batch_size=1000):
+    """Move the payloads of an old Text column to the compressed attachment field
+
+    The old column is emptied batch by batch, the space is reclaimed by the next VACUUM FULL.
+    """
+    model = env[model_name]
+    table = model._table
+    cr = env.cr
+    cr.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+               (table, column))
+    if not cr.fetchone():
+        return
+
+    size_before = _table_size(cr, table)
+    attachment_env = env['ir.attachment'].sudo()
+    last_id = 0
+    count = 0
+    while True:
+        cr.execute('SELECT id, "%s" FROM "%s" WHERE id > %%s AND "%s" IS NOT NULL ORDER BY id LIMIT %%s'
+                   % (column, table, column), (last_id, batch_size))
+        rows = cr.fetchall()
+        if not rows:
+            break
+
+        for record_id, payload in rows:
+            data = compress_payload(payload)
+            if data:
+                attachment_env.create({
+                    'name': data_field,
+                    'res_model': model_name,
+                    'res_field': data_field,
+                    'res_id': record_id,
+                    'type': 'binary',
+                    'datas': data,
+                })
+        ids = tuple(row[0] for row in rows)
+        cr.execute('UPDATE "%s" SET "%s" = NULL WHERE id IN %%s' % (table, column), (ids,))
+        last_id = ids[-1]
+        count += len(ids)
+        _logger.info("%s: %s payloads compressed", model_name, count)
+
+    _logger.info("%s: %s payloads compressed, table %s went from %s to %s bytes (before VACUUM FULL)",
+                 model_name, count, table, size_before, _table_size(cr, table))
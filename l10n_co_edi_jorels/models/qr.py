@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import qrcode
+from odoo import api, fields, models
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+# Images already read or generated by this worker: sha1 of the QR data -> base64 PNG
+_image_cache = OrderedDict()
+_image_cache_lock = threading.Lock()
+IMAGE_CACHE_SIZE = 512
+# The images are stored as the attachments of this pseudo field, so they don't show in the attachments menu
+ATTACHMENT_FIELD = 'qr_image'
+
+
+def render_png(qr_data):
+    """PNG bytes of the QR code of the data"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=4,
+        border=2,
+    )
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+    temp = BytesIO()
+    qr.make_image().save(temp, format="PNG")
+    return temp.getvalue()
+
+
+def get_key(qr_data):
+    return hashlib.sha1(qr_data.encode()).hexdigest()
+
+
+class Qr(models.AbstractModel):
+    _name = "l10n_co_edi_jorels.qr"
+    _description = "QR code images"
+
+    @api.model
+    def _get_attachment_name(self, key):
+        return "qr_%s.png" % key
+
+    @api.model
+    def _cache_get(self, key):
+        with _image_cache_lock:
+            image = _image_cache.get(key)
+            if image is not None:
+                _image_cache.move_to_end(key)
+            return image
+
+    @api.model
+    def _cache_set(self, key, image):
+        with _image_cache_lock:
+            _image_cache[key] = image
+            _image_cache.move_to_end(key)
+            while len(_image_cache) > IMAGE_CACHE_SIZE:
+                _image_cache.popitem(last=False)
+
+    @api.model
+    def _find_images(self, keys):
+        """Images already stored as attachments: key -> base64 PNG"""
+        if not keys:
+            return {}
+        names = {self._get_attachment_name(key): key for key in keys}
+        # With bin_size in the context of the caller, datas would be the size of the file
+        attachments = self.env['ir.attachment'].sudo().with_context(bin_size=False).search([
+            ('res_model', '=', self._name),
+            ('res_field', '=', ATTACHMENT_FIELD),
+            ('name', 'in', list(names)),
+        ])
+        return {names[attachment.name]: attachment.datas for attachment in attachments if attachment.datas}
+
+    @api.model
+    def _store_images(self, images):
+        """Save the generated PNG images, key -> PNG bytes"""
+        attachment_env = self.env['ir.attachment'].sudo()
+        result = {}
+        for key, png in images.items():
+            image = base64.b64encode(png)
+            result[key] = image
+            # Only one worker stores each image, the others just use the one they rendered
+            self._cr.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", ('edipo_qr:' + key,))
+            if not self._cr.fetchone()[0]:
+                _logger.debug("The QR image %s is being stored by another worker", key)
+                continue
+            attachment_env.create({
+                'name': self._get_attachment_name(key),
+                'datas_fname': self._get_attachment_name(key),
+                'res_model': self._name,
+                'res_field': ATTACHMENT_FIELD,
+                'type': 'binary',
+                'mimetype': 'image/png',
+                'datas': image,
+            })
+        return result
+
+    @api.model
+    def get_image(self, qr_data):
+        """Base64 PNG of the QR code of the data, generated only the first time it is requested"""
+        if not qr_data:
+            return False
+        key = get_key(qr_data)
+        image = self._cache_get(key)
+        if image is None:
+            image = self._find_images([key]).get(key)
+            if image is None:
+                image = self._store_images({key: render_png(qr_data)})[key]
+            self._cache_set(key, image)
+        return image
+
+    @api.model
+    def generate_images(self, qr_datas):
+        """Generate the missing images of several QR data"""
+        datas = {get_key(qr_data): qr_data for qr_data in qr_datas if qr_data}
+        missing = set(datas) - set(self._find_images(list(datas)))
+        if not missing:
+            return 0
+
+        self._store_images({key: render_png(datas[key]) for key in missing})
+        return len(missing)
+
+    @api.model
+    def _cron_generate_images(self):
+        batch = int(self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.qr_batch', 500))
+        # Documents validated since the last runs, so their images are ready before they are printed
+        invoices = self.env['account.invoice'].search([
+            ('ei_qr_data', '!=', False),
+            ('write_date', '>=', fields.Datetime.subtract(fields.Datetime.now(), days=1)),
+        ], limit=batch, order='write_date desc')
+        generated = self.generate_images(invoices.mapped('ei_qr_data'))
+        _logger.debug("QR images generated: %s", generated)
+        return True
+
+    @api.model
+    def _cron_gc_images(self):
+        """Delete the stored images that no invoice uses anymore, and the duplicates"""
+        self._cr.execute("SELECT DISTINCT ei_qr_data FROM account_invoice WHERE ei_qr_data IS NOT NULL")
+        used = {self._get_attachment_name(get_key(row[0])) for row in self._cr.fetchall()}
+        # The recent images can belong to documents which are not committed yet
+        self._cr.execute("""
+            SELECT id, name FROM ir_attachment
+            WHERE res_model = %s AND res_field = %s AND create_date < (now() at time zone 'UTC') - interval '1 day'
+            ORDER BY id
+        """, (self._name, ATTACHMENT_FIELD))
+        seen = set()
+        unused_ids = []
+        for attachment_id, name in self._cr.fetchall():
+            if name not in used or name in seen:
+                unused_ids.append(attachment_id)
+            seen.add(name)
+
+        attachment_env = self.env['ir.attachment'].sudo()
+        for ids in split_every(1000, unused_ids):
+            attachment_env.browse(ids).unlink()
+        _logger.debug("QR images deleted: %s", len(unused_ids))
+        return True
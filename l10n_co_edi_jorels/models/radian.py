@@ -23,16 +23,17 @@
 import json
 import logging
 
-import requests
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
 
+from .payload import compress_payload, decompress_payload
+
 _logger = logging.getLogger(__name__)
 
 
 class Radian(models.Model):
     _name = "l10n_co_edi_jorels.radian"
-    _inherit = ['portal.mixin', 'mail.thread', 'mail.activity.mixin']
+    _inherit = ['portal.mixin', 'mail.thread', 'mail.activity.mixin', 'l10n_co_edi_jorels.status_poll.mixin']
     _description = "Radian events"
 
     state = fields.Selection(selection=[
@@ -106,11 +107,14 @@ class Radian(models.Model):
                                            string="Type environment", copy=False, readonly=True,
                                            states={'draft': [('readonly', False)]},
                                            default=lambda self: self._default_edi_type_environment())
-    edi_payload = fields.Text("Payload", copy=False, readonly=True)
+    edi_payload = fields.Text("Payload", compute="_compute_edi_payload", inverse="_inverse_edi_payload",
+                              readonly=True)
+    edi_payload_data = fields.Binary("Compressed payload", attachment=True, copy=False, readonly=True)
 
     # For mail attached
     edi_attached_zip_base64 = fields.Binary('Attached zip', attachment=True, copy=False, readonly=True,
                                             states={'draft': [('readonly', False)]})
+    edi_attached_zip_checksum = fields.Char("Attached zip checksum", copy=False, readonly=True)
 
     user_id = fields.Many2one('res.users', string='Salesperson', track_visibility='onchange',
                               readonly=True, states={'draft': [('readonly', False)]},
@@ -174,6 +178,16 @@ class Radian(models.Model):
                 rec.edi_is_not_test = rec.company_id.is_not_test
             rec.edi_sync = rec.edi_is_not_test
 
+    @api.depends('edi_payload_data')
+    def _compute_edi_payload(self):
+        for rec in self:
+            rec.edi_payload = decompress_payload(rec.with_context(bin_size=False).edi_payload_data)
+
+    @api.multi
+    def _inverse_edi_payload(self):
+        for rec in self:
+            rec.edi_payload_data = compress_payload(rec.edi_payload)
+
     @api.depends("prefix", "number")
     def _compute_name(self):
         for rec in self:
@@ -182,36 +196,42 @@ class Radian(models.Model):
             else:
                 rec.name = _("New")
 
+    @api.model
+    def get_response_vals(self, response, payload):
+        """Values of the document fields for an API response"""
+        return {
+            'edi_is_valid': response['is_valid'],
+            'edi_is_restored': response['is_restored'],
+            'edi_algorithm': response['algorithm'],
+            'edi_class': response['class'],
+            'edi_number': response['number'],
+            'edi_uuid': response['uuid'],
+            'edi_issue_date': response['issue_date'],
+            'edi_expedition_date': response['expedition_date'],
+            'edi_zip_key': response['zip_key'],
+            'edi_status_code': response['status_code'],
+            'edi_status_description': response['status_description'],
+            'edi_status_message': response['status_message'],
+            'edi_errors_messages': str(response['errors_messages']),
+            'edi_xml_name': response['xml_name'],
+            'edi_zip_name': response['zip_name'],
+            'edi_signature': response['signature'],
+            'edi_qr_code': response['qr_code'],
+            'edi_qr_data': response['qr_data'],
+            'edi_qr_link': response['qr_link'],
+            'edi_pdf_download_link': response['pdf_download_link'],
+            'edi_xml_base64': response['xml_base64_bytes'],
+            'edi_application_response_base64': response['application_response_base64_bytes'],
+            'edi_attached_document_base64': response['attached_document_base64_bytes'],
+            'edi_pdf_base64': response['pdf_base64_bytes'],
+            'edi_zip_base64': response['zip_base64_bytes'],
+            'edi_type_environment': response['type_environment_id'],
+            'edi_payload': payload,
+        }
+
     @api.multi
     def write_response(self, response, payload):
-        for rec in self:
-            rec.edi_is_valid = response['is_valid']
-            rec.edi_is_restored = response['is_restored']
-            rec.edi_algorithm = response['algorithm']
-            rec.edi_class = response['class']
-            rec.edi_number = response['number']
-            rec.edi_uuid = response['uuid']
-            rec.edi_issue_date = response['issue_date']
-            rec.edi_expedition_date = response['expedition_date']
-            rec.edi_zip_key = response['zip_key']
-            rec.edi_status_code = response['status_code']
-            rec.edi_status_description = response['status_description']
-            rec.edi_status_message = response['status_message']
-            rec.edi_errors_messages = str(response['errors_messages'])
-            rec.edi_xml_name = response['xml_name']
-            rec.edi_zip_name = response['zip_name']
-            rec.edi_signature = response['signature']
-            rec.edi_qr_code = response['qr_code']
-            rec.edi_qr_data = response['qr_data']
-            rec.edi_qr_link = response['qr_link']
-            rec.edi_pdf_download_link = response['pdf_download_link']
-            rec.edi_xml_base64 = response['xml_base64_bytes']
-            rec.edi_application_response_base64 = response['application_response_base64_bytes']
-            rec.edi_attached_document_base64 = response['attached_document_base64_bytes']
-            rec.edi_pdf_base64 = response['pdf_base64_bytes']
-            rec.edi_zip_base64 = response['zip_base64_bytes']
-            rec.edi_type_environment = response['type_environment_id']
-            rec.edi_payload = payload
+        self.write(self.get_response_vals(response, payload))
 
     @api.multi
     def action_post(self):
@@ -342,16 +362,10 @@ class Radian(models.Model):
                 else:
                     raise UserError(_("You must configure a token"))
 
-                api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                           'https://edipo.jorels.com')
                 params = {
                     'token': token,
                     'code': rec.event_id.code
                 }
-                header = {"accept": "application/json", "Content-Type": "application/json"}
-
-                # Request
-                api_url = api_url + "/basic_event"
 
                 rec.edi_is_not_test = rec.company_id.is_not_test
 
@@ -361,27 +375,18 @@ class Radian(models.Model):
                     else:
                         raise UserError(_("You have not configured a 'TestSetId'."))
 
-                _logger.debug('API URL: %s', api_url)
-                _logger.debug("DIAN Validation Request: %s", json.dumps(requests_data, indent=2, sort_keys=False))
+                _logger.debug("DIAN Validation Request: %s", payload)
                 # raise Warning(json.dumps(requests_data, indent=2, sort_keys=False))
 
-                response = requests.post(api_url,
-                                         json.dumps(requests_data),
-                                         headers=header,
-                                         params=params).json()
-                _logger.debug('API Response: %s', response)
-
-                if 'detail' in response:
-                    raise UserError(response['detail'])
-                if 'message' in response:
-                    if response['message'] == 'Unauthenticated.' or response['message'] == '':
-                        raise UserError(_("Authentication error with the API"))
-                    else:
-                        if 'errors' in response:
-                            raise UserError(response['message'] + '/ errors: ' + str(response['errors']))
-                        else:
-                            raise UserError(response['message'])
-                elif 'is_valid' in response:
+                # Request
+                edipo_env = self.env['l10n_co_edi_jorels.edipo']
+                response = self.env['l10n_co_edi_jorels.ledger'].sudo().send_once(
+                    rec.company_id, "event_" + rec.event_id.code, rec.name,
+                    lambda: edipo_env.request('POST', "/basic_event", requests_data, params),
+                    not rec.edi_is_not_test)
+                edipo_env.check_response(response)
+
+                if 'is_valid' in response:
                     rec.write_response(response, payload)
                     if response['is_valid']:
                         self.env.user.notify_success(message=_("The validation at DIAN has been successful."))
@@ -403,6 +408,38 @@ class Radian(models.Model):
                 _logger.debug("Failed to process the request: %s", e)
                 raise UserError(_("Failed to process the request: %s") % e)
 
+    @api.model
+    def _get_status_poll_domain(self):
+        return [
+            ('state', '=', 'posted'),
+            ('company_id.ei_enable', '=', True),
+            ('edi_is_valid', '=', False),
+            ('edi_status_code', '!=', '99'),
+            '|', ('edi_zip_key', '!=', False), ('edi_uuid', '!=', False),
+        ]
+
+    @api.multi
+    def _get_status_poll_request(self):
+        self.ensure_one()
+        if not self.company_id.api_key:
+            return None
+        params = {
+            'token': self.company_id.api_key,
+            'environment': self.edi_type_environment.id
+        }
+        if self.edi_zip_key:
+            return "/zip/" + self.edi_zip_key, params
+        return "/document/" + self.edi_uuid, params
+
+    @api.multi
+    def _apply_status_poll_response(self, response):
+        self.ensure_one()
+        if 'is_valid' not in response:
+            return False
+        self.write_response(response, self.edi_payload)
+        # 99: Rejected by DIAN
+        return self.edi_is_valid or self.edi_status_code == '99'
+
     @api.multi
     def status_zip(self):
         for rec in self:
@@ -425,39 +462,22 @@ class Radian(models.Model):
                     else:
                         raise UserError(_("You must configure a token"))
 
-                    api_url = self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.api_url',
-                                                                               'https://edipo.jorels.com')
                     params = {
                         'token': token,
                         'environment': rec.edi_type_environment.id
                     }
-                    header = {"accept": "application/json", "Content-Type": "application/json"}
 
                     # Request
                     if rec.edi_zip_key:
-                        api_url = api_url + "/zip/" + rec.edi_zip_key
+                        path = "/zip/" + rec.edi_zip_key
                     else:
-                        api_url = api_url + "/document/" + rec.edi_uuid
+                        path = "/document/" + rec.edi_uuid
 
-                    _logger.debug('API URL: %s', api_url)
+                    edipo_env = self.env['l10n_co_edi_jorels.edipo']
+                    response = edipo_env.request('POST', path, requests_data, params, idempotent=True)
+                    edipo_env.check_response(response)
 
-                    response = requests.post(api_url,
-                                             json.dumps(requests_data),
-                                             headers=header,
-                                             params=params).json()
-                    _logger.debug('API Response: %s', response)
-
-                    if 'detail' in response:
-                        raise UserError(response['detail'])
-                    if 'message' in response:
-                        if response['message'] == 'Unauthenticated.' or response['message'] == '':
-                            raise UserError(_("Authentication error with the API"))
-                        else:
-                            if 'errors' in response:
-                                raise UserError(response['message'] + '/ errors: ' + str(response['errors']))
-                            else:
-                                raise UserError(response['message'])
-                    elif 'is_valid' in response:
+                    if 'is_valid' in response:
                         rec.write_response(response, payload)
                         if response['is_valid']:
                             self.env.user.notify_success(message=_("The validation at DIAN has been successful."))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import logging
+import random
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class StatusPollMixin(models.AbstractModel):
+    _name = "l10n_co_edi_jorels.status_poll.mixin"
+    _description = "DIAN status polling"
+
+    edi_poll_attempts = fields.Integer(string="Status polls", default=0, copy=False, readonly=True)
+    edi_poll_next_date = fields.Datetime(string="Next status poll", copy=False, readonly=True, index=True)
+
+    @api.model
+    def _get_status_poll_domain(self):
+        """Documents with a zip key or UUID that do not have a final status yet"""
+        return []
+
+    @api.multi
+    def _get_status_poll_request(self):
+        """Return the API path and query parameters of the status request, or None if it can't be done"""
+        self.ensure_one()
+        return None
+
+    @api.multi
+    def _apply_status_poll_response(self, response):
+        """Save the status response and return True if the document reached a final status"""
+        self.ensure_one()
+        return True
+
+    @api.model
+    def _get_status_poll_param(self, name, default):
+        return int(self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.poll_' + name, default))
+
+    @api.model
+    def _get_status_poll_delay(self, attempts):
+        """Exponential backoff with jitter, in seconds"""
+        base_delay = self._get_status_poll_param('base_delay', 60)
+        max_delay = self._get_status_poll_param('max_delay', 86400)
+        delay = min(base_delay * 2 ** attempts, max_delay)
+        return random.uniform(delay / 2.0, delay)
+
+    @api.model
+    def _poll_status(self, limit):
+        """Query the status of a batch of pending documents. Return the number of documents polled"""
+        now = fields.Datetime.now()
+        max_attempts = self._get_status_poll_param('max_attempts', 12)
+        domain = self._get_status_poll_domain() + [
+            ('edi_poll_attempts', '<', max_attempts),
+            '|', ('edi_poll_next_date', '=', False), ('edi_poll_next_date', '<=', now),
+        ]
+        records = self.search(domain, limit=limit, order='edi_poll_next_date, id')
+        if not records:
+            return 0
+
+        calls = []
+        for rec in records:
+            request = rec._get_status_poll_request()
+            if request:
+                path, params = request
+                calls.append((rec.id, 'POST', path, {}, params))
+
+        edipo_env = self.env['l10n_co_edi_jorels.edipo']
+        responses = edipo_env.request_many(calls, idempotent=True)
+
+        done = self.browse()
+        for rec in records:
+            # Applying the response can write the document, the attempts are read before
+            attempts = rec.edi_poll_attempts + 1
+            final = False
+            response = responses.get(rec.id)
+            if response is not None:
+                try:
+                    if isinstance(response, Exception):
+                        raise response
+                    edipo_env.check_response(response)
+                    with self._cr.savepoint():
+                        final = rec._apply_status_poll_response(response)
+                except Exception as e:
+                    _logger.debug("Failed to poll the status of %s: %s", rec, e)
+            if final:
+                done |= rec
+            else:
+                # Each document gets its own jitter, so the retries are spread over time
+                rec.write({
+                    'edi_poll_attempts': attempts,
+                    'edi_poll_next_date': now + timedelta(seconds=self._get_status_poll_delay(attempts)),
+                })
+
+        if done:
+            done.write({'edi_poll_attempts': 0, 'edi_poll_next_date': False})
+
+        _logger.debug("Status polling of %s: %s final, %s pending", self._name, len(done),
+                      len(records) - len(done))
+        return len(records)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+#
+# Jorels S.A.S. - Copyright (2019-2022)
+#
+# This file is part of l10n_co_edi_jorels.
+#
+# l10n_co_edi_jorels is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# l10n_co_edi_jorels is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with l10n_co_edi_jorels.  If not, see <https://www.gnu.org/licenses/>.
+#
+# email: info@jorels.com
+#
+
+import logging
+import threading
+import time
+
+import odoo
+from odoo import api, fields, models, tools, _
+
+_logger = logging.getLogger(__name__)
+
+
+class Submission(models.Model):
+    _name = "l10n_co_edi_jorels.submission"
+    _description = "DIAN submission queue"
+    _order = "id desc"
+    _rec_name = "invoice_id"
+
+    invoice_id = fields.Many2one(comodel_name='account.invoice', string="Invoice", required=True, readonly=True,
+                                 index=True, ondelete='cascade')
+    company_id = fields.Many2one(comodel_name='res.company', string="Company", related='invoice_id.company_id',
+                                 store=True, readonly=True)
+    number_formatted = fields.Char(string="Number", related='invoice_id.number_formatted', readonly=True)
+    is_test = fields.Boolean(string="Test", default=False, readonly=True)
+    user_id = fields.Many2one(comodel_name='res.users', string="Requested by", readonly=True,
+                              default=lambda self: self.env.uid, ondelete='set null')
+    job_type = fields.Selection([
+        ('dian', 'DIAN submission'),
+        ('mail', 'Email'),
+    ], string="Job type", default='dian', required=True, readonly=True, index=True)
+    mail_id = fields.Many2one(comodel_name='mail.mail', string="Email", readonly=True, copy=False,
+                              ondelete='set null')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('error', 'Error'),
+    ], string="Status", default='pending', required=True, readonly=True, index=True, copy=False)
+    attempts = fields.Integer(string="Attempts", default=0, readonly=True, copy=False)
+    message = fields.Text(string="Message", readonly=True, copy=False)
+    date_enqueued = fields.Datetime(string="Enqueued on", default=fields.Datetime.now, readonly=True)
+    date_started = fields.Datetime(string="Started on", readonly=True, copy=False)
+    date_done = fields.Datetime(string="Finished on", readonly=True, copy=False)
+    duration = fields.Float(string="Duration (s)", readonly=True, copy=False, group_operator='avg')
+
+    @api.model
+    def _get_queue_param(self, name, default):
+        return int(self.env['ir.config_parameter'].sudo().get_param('jorels.edipo.queue_' + name, default))
+
+    @api.model
+    def enqueue(self, invoices, is_test, job_type='dian'):
+        """Add the invoices to the queue, unless they already have a pending job of the same type"""
+        pending = self.search([('invoice_id', 'in', invoices.ids), ('state', '=', 'pending'),
+                               ('job_type', '=', job_type)])
+        to_enqueue = invoices - pending.mapped('invoice_id')
+        for invoice in to_enqueue:
+            self.create({
+                'invoice_id': invoice.id,
+                'is_test': is_test,
+                'job_type': job_type,
+            })
+        return to_enqueue
+
+    @api.model
+    def _claim_next(self, job_type='dian'):
+        # Each worker locks its own job, the rest of the workers skip it.
+        # Emails are claimed only while they still have to be rendered.
+        self._cr.execute("""
+            SELECT id FROM l10n_co_edi_jorels_submission
+            WHERE state = 'pending' AND job_type = %s AND (job_type != 'mail' OR mail_id IS NULL)
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """, (job_type,))
+        row = self._cr.fetchone()
+        return self.browse(row[0]) if row else self.browse()
+
+    @api.multi
+    def _process(self):
+        max_attempts = self._get_queue_param('max_attempts', 3)
+        edipo_env = self.env['l10n_co_edi_jorels.edipo']
+        for rec in self:
+            # The document is sent with the rights of the user who queued it, not the cron's
+            invoice = rec.invoice_id.sudo(rec.user_id.id) if rec.user_id else rec.invoice_id
+            started = time.time()
+            rec.write({'date_started': fields.Datetime.now()})
+            try:
+                with self._cr.savepoint():
+                    invoice.with_context(edipo_no_contingency=True).validate_dian_generic(rec.is_test)
+                    # Documents validated from the form wait in 'validate' until DIAN answers
+                    if invoice.state == 'validate':
+                        invoice.write({'state': 'open'})
+                    if not rec.is_test and invoice.ei_is_not_test and invoice.ei_is_valid \
+                            and invoice.company_id.enable_mass_send_print:
+                        invoice.enqueue_edi_mail()
+                rec.write({
+                    'state': 'done',
+                    'message': invoice.ei_status_description or False,
+                })
+            except Exception as e:
+                _logger.debug("DIAN submission %s failed: %s", rec.id, e)
+                # Failures while the API is down don't count, the document waits until it recovers
+                attempts = rec.attempts + 1 if edipo_env.is_api_available() else rec.attempts
+                rec.write({
+                    'state': 'pending' if attempts < max_attempts else 'error',
+                    'attempts': attempts,
+                    'message': str(e),
+                })
+            rec.write({
+                'date_done': fields.Datetime.now(),
+                'duration': time.time() - started,
+            })
+
+    @api.model
+    def _process_queue_worker(self, dbname, uid, context, limit, interval=0):
+        with api.Environment.manage():
+            registry = odoo.registry(dbname)
+            for i in range(limit):
+                if i and interval:
+                    time.sleep(interval)
+                # One transaction per document, so a slow answer does not block the rest of the queue
+                with registry.cursor() as cr:
+                    env = api.Environment(cr, uid, context)
+                    # While the circuit breaker is open the queue is kept, until a probe is due
+                    if not env['l10n_co_edi_jorels.edipo'].is_api_available():
+                        break
+                    job = env['l10n_co_edi_jorels.submission']._claim_next()
+                    if not job:
+                        break
+                    job._process()
+
+    @api.multi
+    def _fail(self, message):
+        max_attempts = self._get_queue_param('max_attempts', 3)
+        for rec in self:
+            attempts = rec.attempts + 1
+            rec.write({
+                'state': 'pending' if attempts < max_attempts else 'error',
+                'attempts': attempts,
+                'message': message,
+            })
+
+    @api.multi
+    def _render_mail(self):
+        """Render the invoice emails, with their attachments, as outgoing mail.mail"""
+        default_template = self.env.ref('account.email_template_edi_invoice', raise_if_not_found=False)
+        for rec in self:
+            rec.write({'date_started': fields.Datetime.now()})
+            invoice = rec.invoice_id
+            template = invoice.company_id.ei_mail_template_id or default_template
+            try:
+                if not invoice.ei_is_valid:
+                    raise ValueError(_("The invoice has not been validated by DIAN"))
+                with self._cr.savepoint():
+                    if not invoice.company_id.ei_mail_template_id and hasattr(invoice, 'mass_send_print'):
+                        # Account Invoice Mass Sending picks its own template and attachments and sends it
+                        invoice.mass_send_print()
+                        rec.write({
+                            'state': 'done',
+                            'message': False,
+                            'date_done': fields.Datetime.now(),
+                        })
+                        continue
+                    if not template:
+                        raise ValueError(_("The invoice email template was not found"))
+                    mail_id = template.with_context(active_model='account.invoice').send_mail(
+                        invoice.id, force_send=False)
+                    # Cancelled until this queue sends it, so the mail queue of Odoo doesn't send it as well
+                    self.env['mail.mail'].browse(mail_id).write({'state': 'cancel'})
+                    invoice.write({'sent': True})
+                    rec.write({'mail_id': mail_id})
+            except Exception as e:
+                _logger.debug("Invoice email %s could not be rendered: %s", rec.id, e)
+                rec._fail(str(e))
+
+    @api.model
+    def _render_mail_worker(self, dbname, uid, context, limit):
+        with api.Environment.manage():
+            registry = odoo.registry(dbname)
+            for i in range(limit):
+                with registry.cursor() as cr:
+                    env = api.Environment(cr, uid, context)
+                    job = env['l10n_co_edi_jorels.submission']._claim_next('mail')
+                    if not job:
+                        break
+                    job._render_mail()
+
+    @api.multi
+    def _send_mail(self):
+        """Send the rendered emails, mail.mail uses one SMTP connection per batch"""
+        mails = self.mapped('mail_id')
+        mails.filtered(lambda mail: mail.state in ('cancel', 'exception')).write({'state': 'outgoing'})
+        mails.send(auto_commit=False, raise_exception=False)
+
+        # Sent emails are usually deleted right away
+        sent = self.env['mail.mail'].browse(mails.ids).exists()
+        for rec in self:
+            mail = rec.mail_id & sent
+            if mail and mail.state == 'exception':
+                rec._fail(mail.failure_reason or _("The email could not be sent"))
+            elif not mail or mail.state == 'sent':
+                rec.write({
+                    'state': 'done',
+                    'message': False,
+                    'date_done': fields.Datetime.now(),
+                })
+
+    @api.model
+    def _cron_process_mail_queue(self):
+        workers = max(self._get_queue_param('mail_workers', 4), 1)
+        batch = self._get_queue_param('mail_batch', 50)
+
+        # Reports and zips are rendered in parallel, one transaction per email
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._render_mail_worker,
+                                      args=(self._cr.dbname, self._uid, dict(self._context), batch),
+                                      name="edipo_mail_%s" % i)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        # The cron cursor still sees the snapshot taken before the workers committed
+        with self.pool.cursor() as cr:
+            submission_env = self.with_env(self.env(cr=cr))
+            jobs = submission_env.search([('job_type', '=', 'mail'), ('state', '=', 'pending'),
+                                          ('mail_id', '!=', False)])
+            for ids in tools.split_every(batch, jobs.ids):
+                submission_env.browse(ids)._send_mail()
+                cr.commit()
+        return True
+
+    @api.model
+    def _cron_process_queue(self):
+        workers = max(self._get_queue_param('workers', 2), 1)
+        batch = self._get_queue_param('batch', 100)
+        # Maximum documents per minute, so the queue doesn't flood the API when it comes back
+        rate = self._get_queue_param('rate', 0)
+        interval = workers * 60.0 / rate if rate else 0
+        started = time.time()
+
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._process_queue_worker,
+                                      args=(self._cr.dbname, self._uid, dict(self._context), batch // workers or 1,
+                                            interval),
+                                      name="edipo_queue_%s" % i)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        # The cron cursor still sees the snapshot taken before the workers committed
+        with self.pool.cursor() as cr:
+            stats = self.with_env(self.env(cr=cr)).get_queue_stats(since=started)
+        _logger.info("DIAN queue: %s done, %s pending, %s error, %.2f documents/minute",
+                     stats['done'], stats['pending'], stats['error'], stats['throughput'])
+        return True
+
+    @api.model
+    def get_queue_stats(self, since=None, job_type='dian'):
+        """Number of documents per status and throughput (documents per minute) since a timestamp"""
+        stats = {'pending': 0, 'done': 0, 'error': 0, 'throughput': 0.0, 'avg_duration': 0.0}
+        self._cr.execute("SELECT state, count(*) FROM l10n_co_edi_jorels_submission WHERE job_type = %s "
+                         "GROUP BY state", (job_type,))
+        stats.update(dict(self._cr.fetchall()))
+
+        if since is None:
+            since = time.time() - 3600
+        self._cr.execute("""
+            SELECT count(*), coalesce(avg(duration), 0),
+                   extract(epoch FROM max(date_done) - min(date_started))
+            FROM l10n_co_edi_jorels_submission
+            WHERE state = 'done' AND job_type = %s AND date_done >= to_timestamp(%s) AT TIME ZONE 'UTC'
+        """, (job_type, since))
+        count, avg_duration, elapsed = self._cr.fetchone()
+        stats['avg_duration'] = avg_duration
+        if count and elapsed:
+            stats['throughput'] = count * 60.0 / elapsed
+        return stats
+
+    @api.multi
+    def action_retry(self):
+        self.filtered(lambda rec: rec.state == 'error').write({'state': 'pending', 'attempts': 0})
+        return True
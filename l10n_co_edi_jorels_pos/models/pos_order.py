@@ -41,10 +41,12 @@ class PosOrder(models.Model):
     @api.multi
     def get_invoice(self):
         self.ensure_one()
+        qr_image = self.invoice_id.ei_qr_image
         return {
             "number": self.invoice_id.number,
             "ei_uuid": self.invoice_id.ei_uuid,
             "ei_qr_data": self.invoice_id.ei_qr_data,
+            "ei_qr_image": qr_image.decode() if qr_image else False,
             "ei_is_valid": self.invoice_id.ei_is_valid,
             "resolution_resolution": self.invoice_id.resolution_id.resolution_resolution,
             "resolution_resolution_date": self.invoice_id.resolution_id.resolution_resolution_date,
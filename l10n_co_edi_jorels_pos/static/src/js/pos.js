@@ -345,11 +345,20 @@ odoo.define('l10n_co_edi_jorels_pos', function(require) {
 			this._super();
 			var order = this.pos.get_order();
 			if (order.invoice && order.invoice.ei_qr_data && order.invoice.ei_is_valid){
-				new QRCode(document.getElementById("ei_qr_data") , {
-					text: String(order.invoice.ei_qr_data),
-					width: 100,
-					height: 100
-				});
+				if (order.invoice.ei_qr_image) {
+					// Image generated and cached by the server
+					var img = document.createElement("img");
+					img.src = "data:image/png;base64," + order.invoice.ei_qr_image;
+					img.style.width = "100px";
+					img.style.height = "100px";
+					document.getElementById("ei_qr_data").appendChild(img);
+				} else {
+					new QRCode(document.getElementById("ei_qr_data") , {
+						text: String(order.invoice.ei_qr_data),
+						width: 100,
+						height: 100
+					});
+				}
 			}
 		},
 	});
@@ -19,6 +19,7 @@
 #   email: info@jorels.com
 #
 
+from . import edipo
 from . import res_company
 from . import res_config_settings
 from . import earn_line
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+#
+#   l10n_co_hr_payroll
+#   Copyright (C) 2022  Jorels SAS
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as published
+#   by the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#   email: info@jorels.com
+#
+
+from odoo import api, models
+
+
+class Edipo(models.AbstractModel):
+    _inherit = "l10n_co_edi_jorels.edipo"
+
+    @api.model
+    def _get_status_poll_models(self):
+        return super(Edipo, self)._get_status_poll_models() + ['hr.payslip', 'hr.payslip.edi']
@@ -20,23 +20,150 @@
 # email: info@jorels.com
 #
 
-from odoo import api, fields, models, _
+from odoo import api, fields, models, tools, _
+from odoo.exceptions import UserError
 from odoo.modules import module
 
 import csv
+import hashlib
+import io
+import json
+import time
+import zipfile
 from pathlib import Path
 
 import logging
 
 _logger = logging.getLogger(__name__)
 
+SNAPSHOT_VERSION = 1
+
+# Snapshots of the server configuration already read by this worker: path -> tables
+_snapshot_cache = {}
+
 
 class ResCompany(models.Model):
     _inherit = 'res.company'
 
+    @api.model
+    def _get_csv_columns(self, csv_file):
+        columns = next(csv.reader(csv_file, delimiter=',', quotechar='"'))
+        csv_file.seek(0)
+        return columns
+
+    @api.model
+    def _copy_csv_to_staging(self, table_name, columns, csv_file):
+        """Stream the csv file into a temporary table with the columns of the catalog table
+
+        :return: name of the staging table and number of rows
+        """
+        staging_name = "csv_staging_" + table_name
+        column_list = ",".join('"%s"' % column for column in columns)
+        self._cr.execute(f'DROP TABLE IF EXISTS "{staging_name}"')
+        self._cr.execute(f'CREATE TEMP TABLE "{staging_name}" AS SELECT {column_list} FROM "{table_name}" WITH NO DATA')
+        self._cr.copy_expert(f'COPY "{staging_name}" ({column_list}) FROM STDIN WITH (FORMAT csv, HEADER true)',
+                             csv_file)
+        self._cr.execute(f'SELECT count(*) FROM "{staging_name}"')
+        return staging_name, self._cr.fetchone()[0]
+
+    @api.model
+    def _get_referencing_columns(self, table_name):
+        """(table, column) of the foreign keys pointing to the table"""
+        self._cr.execute("""
+            SELECT cl.relname, att.attname
+            FROM pg_constraint con
+            JOIN pg_class cl ON cl.oid = con.conrelid
+            JOIN pg_attribute att ON att.attrelid = con.conrelid AND att.attnum = con.conkey[1]
+            WHERE con.contype = 'f' AND con.confrelid = %s::regclass
+        """, (table_name,))
+        return self._cr.fetchall()
+
+    @api.model
+    def _sync_from_staging(self, table_name, staging_name, columns):
+        """Apply the row-level diff between the staging and the catalog table
+
+        Removed rows which are still referenced are kept, so no document loses its value.
+
+        :return: dict with the number of inserted, updated, removed and kept rows
+        """
+        uid = self.env.user.id
+        column_list = ",".join('"%s"' % column for column in columns)
+        data_columns = [column for column in columns if column != 'id']
+        summary = {}
+
+        self._cr.execute(f"""
+            INSERT INTO "{table_name}" ({column_list},create_uid,create_date,write_uid,write_date)
+            SELECT {",".join('s."%s"' % column for column in columns)},%s,NOW(),%s,NOW()
+            FROM "{staging_name}" s
+            WHERE NOT EXISTS (SELECT 1 FROM "{table_name}" t WHERE t.id = s.id)
+        """, (uid, uid))
+        summary['inserted'] = self._cr.rowcount
+
+        summary['updated'] = 0
+        if data_columns:
+            self._cr.execute(f"""
+                UPDATE "{table_name}" t
+                SET {",".join('"%s"=s."%s"' % (column, column) for column in data_columns)},
+                    write_uid=%s,write_date=NOW()
+                FROM "{staging_name}" s
+                WHERE t.id = s.id
+                  AND ({",".join('t."%s"' % column for column in data_columns)})
+                      IS DISTINCT FROM ({",".join('s."%s"' % column for column in data_columns)})
+            """, (uid,))
+            summary['updated'] = self._cr.rowcount
+
+        removed_where = f'NOT EXISTS (SELECT 1 FROM "{staging_name}" s WHERE s.id = t.id)'
+        self._cr.execute(f'SELECT count(*) FROM "{table_name}" t WHERE {removed_where}')
+        removed = self._cr.fetchone()[0]
+        summary['removed'] = 0
+        if removed:
+            not_referenced = "".join(
+                f' AND NOT EXISTS (SELECT 1 FROM "{ref_table}" r WHERE r."{ref_column}" = t.id)'
+                for ref_table, ref_column in self._get_referencing_columns(table_name))
+            self._cr.execute(f'DELETE FROM "{table_name}" t WHERE {removed_where}{not_referenced}')
+            summary['removed'] = self._cr.rowcount
+        summary['kept'] = removed - summary['removed']
+        return summary
+
+    @api.model
+    def _fix_sequence(self, table_name):
+        self._cr.execute(f"""SELECT setval('{table_name}_id_seq', COALESCE((SELECT max(id) FROM "{table_name}"), 0) + 1,
+                             false)""")
+
+    @api.model
+    def _get_csv_checksum_key(self, table_name):
+        return 'update_from_csv.checksum.' + table_name
+
+    @api.model
+    def _load_catalog(self, table_name, csv_file, checksum, sequence=None):
+        """Sync a catalog table from a csv file object and save its checksum
+
+        :param sequence: next value of the id sequence, it is computed from the ids if not given
+        :return: (number of rows of the file, diff summary)
+        """
+        columns = self._get_csv_columns(csv_file)
+        _logger.debug(f'Column names are {", ".join(columns)}')
+
+        staging_name, line_count = self._copy_csv_to_staging(table_name, columns, csv_file)
+        summary = self._sync_from_staging(table_name, staging_name, columns)
+        self._cr.execute(f'DROP TABLE "{staging_name}"')
+        if sequence:
+            # The rows kept because they are still referenced can have higher ids than the snapshot
+            self._cr.execute(f"""SELECT setval('{table_name}_id_seq',
+                                 GREATEST(%s, COALESCE((SELECT max(id) FROM "{table_name}"), 0) + 1), false)""",
+                             (sequence,))
+        elif summary['inserted']:
+            self._fix_sequence(table_name)
+
+        self._cr.execute(f'SELECT count(*) FROM "{table_name}"')
+        self.env['ir.config_parameter'].sudo().set_param(self._get_csv_checksum_key(table_name),
+                                                         "%s:%s" % (checksum, self._cr.fetchone()[0]))
+        return line_count, summary
+
     @api.multi
     def init_csv_data(self, model):
         try:
+            started = time.time()
             module_name = model.split('.')[0]
             model = model[len(module_name) + 1:]
             file_name = model + '.csv'
@@ -46,39 +173,181 @@ class ResCompany(models.Model):
             file_path = Path(module_path) / 'data' / file_name
             table_name = model.replace(".", "_")
 
-            with open(file_path, mode="r", encoding="utf-8-sig") as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
-                line_count = 0
-                for row in csv_reader:
-                    if line_count == 0:
-                        _logger.debug(f'Column names are {", ".join(row)}')
-                        field_names = row
-
-                    # Insert
-                    query = "insert into " + table_name + "("
-                    for field_name in field_names:
-                        query = query + field_name + ","
-                    query = query + "create_uid,create_date,write_uid,write_date) values("
-                    for field_name in field_names:
-                        query = query + "$$" + row[field_name] + "$$,"
-                    query = query + str(self.env.user.id) + ',NOW(),' + str(
-                        self.env.user.id) + ',NOW()) ON CONFLICT(id) DO UPDATE SET '
-
-                    # Update
-                    for field_name in field_names:
-                        query = query + field_name + "=$$" + row[field_name] + "$$,"
-                    query = query + "write_uid=" + str(self.env.user.id) + ",write_date=NOW()"
-
-                    # Execute query
-                    #_logger.debug(query)
-                    self._cr.execute(query)
-
-                    # Count
-                    line_count += 1
-
-                self._cr.execute("select max(id) from " + table_name)
-                max_id = self._cr.dictfetchall()[0]['max']
-                self._cr.execute(f"SELECT setval('{table_name}_id_seq',{str(max_id + 1)}, true)")
-                _logger.debug(f'Processed {line_count} records on table {table_name}')
+            config_env = self.env['ir.config_parameter'].sudo()
+            checksum_key = self._get_csv_checksum_key(table_name)
+            checksum = hashlib.sha256(file_path.read_bytes()).hexdigest()
+
+            # A failed catalog is rolled back alone, the rest of the transaction goes on
+            with self._cr.savepoint():
+                # The checksum is saved with the number of rows, an emptied table is loaded again
+                self._cr.execute(f'SELECT count(*) FROM "{table_name}"')
+                if config_env.get_param(checksum_key) == "%s:%s" % (checksum, self._cr.fetchone()[0]) \
+                        and not self._context.get('csv_force_sync'):
+                    _logger.info("Catalog %s: unchanged, skipped", table_name)
+                    return
+
+                # New databases can take the catalog from the snapshot of the server configuration
+                snapshot_table = self._get_configured_snapshot().get(table_name)
+                loaded = None
+                if snapshot_table and snapshot_table['source_checksum'] == checksum:
+                    try:
+                        with self._cr.savepoint():
+                            loaded = self._load_snapshot_table(snapshot_table)
+                    except Exception as e:
+                        _logger.warning("Catalog %s: the snapshot could not be loaded, the csv file is used: %s",
+                                        table_name, e)
+                if loaded:
+                    line_count, summary = loaded
+                else:
+                    with open(file_path, mode="r", encoding="utf-8-sig", newline="") as csv_file:
+                        line_count, summary = self._load_catalog(table_name, csv_file, checksum)
+
+            _logger.info("Catalog %s: %s rows, %s inserted, %s updated, %s removed, %s kept (still referenced) "
+                         "in %.3fs", table_name, line_count, summary['inserted'], summary['updated'],
+                         summary['removed'], summary['kept'], time.time() - started)
+
+            # Cached listings are stale now; this is signaled to all workers
+            if summary['inserted'] or summary['updated'] or summary['removed']:
+                self.clear_caches()
         except Exception as e:
             _logger.debug("init_csv_data %s", e)
+
+    @api.model
+    def _get_snapshot_tables(self):
+        """Catalog tables loaded by init_csv_data, the referenced tables first"""
+        params = self.env['ir.config_parameter'].sudo().search([('key', '=like', 'update_from_csv.checksum.%')])
+        tables = sorted(param.key[len('update_from_csv.checksum.'):] for param in params)
+        self._cr.execute("SELECT relname FROM pg_class WHERE relkind = 'r' AND relname IN %s",
+                         (tuple(tables) or ('',),))
+        existing = {row[0] for row in self._cr.fetchall()}
+
+        ordered = []
+        visiting = set()
+
+        def visit(table):
+            if table in ordered or table in visiting:
+                return
+            visiting.add(table)
+            self._cr.execute("""
+                SELECT DISTINCT ref.relname
+                FROM pg_constraint con
+                JOIN pg_class ref ON ref.oid = con.confrelid
+                WHERE con.contype = 'f' AND con.conrelid = %s::regclass
+            """, (table,))
+            for referenced, in self._cr.fetchall():
+                if referenced in existing and referenced != table:
+                    visit(referenced)
+            ordered.append(table)
+
+        for table in tables:
+            if table in existing:
+                visit(table)
+        return ordered
+
+    @api.model
+    def _export_catalog_snapshot(self):
+        """Pack every catalog table in a zip, with a manifest of checksums and sequence values
+
+        :return: zip bytes
+        """
+        config_env = self.env['ir.config_parameter'].sudo()
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'created': fields.Datetime.to_string(fields.Datetime.now()),
+            'tables': [],
+        }
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as snapshot:
+            for table_name in self._get_snapshot_tables():
+                # The audit columns are set by the importing database
+                self._cr.execute("""
+                    SELECT column_name FROM information_schema.columns
+                    WHERE table_name = %s AND column_name NOT IN ('create_uid', 'create_date', 'write_uid', 'write_date')
+                    ORDER BY ordinal_position
+                """, (table_name,))
+                column_list = ",".join('"%s"' % row[0] for row in self._cr.fetchall())
+                data = io.BytesIO()
+                self._cr.copy_expert(f'COPY (SELECT {column_list} FROM "{table_name}" ORDER BY id) TO STDOUT '
+                                     f'WITH (FORMAT csv, HEADER true)', data)
+                content = data.getvalue()
+                self._cr.execute(f'SELECT count(*) FROM "{table_name}"')
+                rows = self._cr.fetchone()[0]
+
+                self._cr.execute(f"SELECT last_value, is_called FROM {table_name}_id_seq")
+                last_value, is_called = self._cr.fetchone()
+                file_name = table_name + '.csv'
+                snapshot.writestr(file_name, content)
+                manifest['tables'].append({
+                    'table': table_name,
+                    'file': file_name,
+                    'rows': rows,
+                    'sha256': hashlib.sha256(content).hexdigest(),
+                    'sequence': last_value + 1 if is_called else last_value,
+                    'source_checksum': (config_env.get_param(self._get_csv_checksum_key(table_name)) or '')
+                    .split(':')[0],
+                })
+            snapshot.writestr('manifest.json', json.dumps(manifest, indent=2))
+        return buffer.getvalue()
+
+    @api.model
+    def _read_snapshot(self, data):
+        """Tables of a snapshot, after verifying its version and checksums
+
+        :return: dict table name -> manifest entry, with the file content in 'content'
+        """
+        with zipfile.ZipFile(io.BytesIO(data)) as snapshot:
+            manifest = json.loads(snapshot.read('manifest.json').decode('utf-8'))
+            if manifest.get('version') != SNAPSHOT_VERSION:
+                raise UserError(_("Unsupported catalog snapshot version: %s") % manifest.get('version'))
+            tables = {}
+            for entry in manifest['tables']:
+                content = snapshot.read(entry['file'])
+                if hashlib.sha256(content).hexdigest() != entry['sha256']:
+                    raise UserError(_("The catalog snapshot is corrupted: %s") % entry['file'])
+                tables[entry['table']] = dict(entry, content=content)
+        return tables
+
+    @api.model
+    def _get_configured_snapshot(self):
+        """Tables of the snapshot set with the csv_snapshot option of the server configuration"""
+        path = tools.config.get('csv_snapshot')
+        if not path:
+            return {}
+        if path not in _snapshot_cache:
+            _snapshot_cache[path] = self._read_snapshot(Path(path).read_bytes())
+        return _snapshot_cache[path]
+
+    @api.model
+    def _load_snapshot_table(self, entry):
+        csv_file = io.StringIO(entry['content'].decode('utf-8'))
+        line_count, summary = self._load_catalog(entry['table'], csv_file, entry['source_checksum'],
+                                                 entry['sequence'])
+        if line_count != entry['rows']:
+            raise UserError(_("The catalog snapshot table %s has %s rows, %s were expected") % (
+                entry['table'], line_count, entry['rows']))
+        return line_count, summary
+
+    @api.model
+    def _import_catalog_snapshot(self, data):
+        """Load the catalogs of a snapshot made by _export_catalog_snapshot, with the same ids and sequences
+
+        The snapshot is verified before any table is touched. Only the catalogs already loaded by
+        init_csv_data in this database are imported, the rest of the tables are skipped.
+
+        :return: dict table name -> number of rows loaded
+        """
+        tables = self._read_snapshot(data)
+        if not tables:
+            return {}
+        catalogs = set(self._get_snapshot_tables())
+        for table_name in set(tables) - catalogs:
+            _logger.warning("Catalog snapshot: %s is not a catalog of this database, it is skipped", table_name)
+
+        result = {}
+        with self._cr.savepoint():
+            for table_name, entry in tables.items():
+                if table_name in catalogs:
+                    result[table_name] = self._load_snapshot_table(entry)[0]
+        self.clear_caches()
+        _logger.info("Catalog snapshot: %s tables loaded, %s skipped", len(result), len(tables) - len(result))
+        return result